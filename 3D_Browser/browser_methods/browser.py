@@ -26,6 +26,10 @@ import numpy as np
 import cv2
 
 distrPath = os.path.dirname( os.path.abspath(sys.argv[0]) )
+# profiling is shared with the pipeline: imported on its own from
+# bundle_methods, the package itself pulls in all of the pipeline
+sys.path.append(os.path.join(os.path.dirname(distrPath), "bundle_methods"))
+import profiling
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 class Browser(object):
@@ -51,6 +55,8 @@ class Browser(object):
 		self.parseCommandLineFlags()
 
 		self.currentDir = os.getcwd()
+		# prepare_data and every Visualize.on_draw are profiled with -pf or PUPIL3D_PROFILE
+		self.profiler = profiling.Profiler(profiling.profile_dir(self.profile), "RunBrowser")
 		#self.workDir = tempfile.mkdtemp(prefix="SfM_Browser_")
 		#logging.info("Working directory created: "+self.workDir)
 		self.exceptions()
@@ -64,6 +70,8 @@ class Browser(object):
 
 		parser.add_argument('-v', '--verbose', type=bool, default=False, 
 			help='Set to True for verbose dialogue')
+		parser.add_argument('-pf', '--profile', type=str, default=None,
+			help="Profile loading the data and drawing into this directory, see bundle_methods/profiling.py. Default = $%s, no profiling if unset." % profiling.PROFILE_ENV)
 		
 		try:
 			args = parser.parse_args(namespace=self)						
@@ -188,7 +196,8 @@ class Browser(object):
 
 	def run(self):
 		vis = Visualize()
-		vis._set_Points_Cameras(*self.prepare_data())
+		vis._set_Points_Cameras(*self.profiler.stage("prepare_data", self.prepare_data)())
+		vis.on_draw = self.profiler.calls("on_draw", vis.on_draw)
 		vis.main()
 		
 
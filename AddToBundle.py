@@ -1,5 +1,6 @@
 import logging
 import bundle_methods
+from bundle_methods.metrics import Metrics
 from time import time
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
@@ -9,26 +10,24 @@ t = time()
 
 manager = bundle_methods.Bundler()
 
-start_time = time()
+# time, memory, I/O and output counts of every stage (see bundle_methods/metrics.py)
+metrics = Metrics(manager.sfm_path, "AddToBundle", t)
 
-manager.prepare_photos()
+# profiled with -pf (see bundle_methods/profiling.py)
+profile = manager.profiler.stage
 
-current_time = time()
-prep_t = current_time-start_time
-print "\nPrepare Photos & Feature Extraction took: %s seconds\nElapsed Time: %s\n" %(prep_t, current_time-t)
+metrics.timed("Prepare Photos", profile("prepare_photos", manager.prepare_photos), lambda: manager.stage_counts("extract"))()
 
-start_time = time()
+metrics.timed("Match Features", profile("match_added_features", manager.match_added_features), lambda: manager.stage_counts("match"))()
 
-manager.add_to_bundle()
+metrics.timed("Bundle Adjustment", profile("add_to_bundle", manager.add_to_bundle), lambda: manager.stage_counts("bundle"))()
 
 current_time = time()
-bundle_t = current_time-start_time
-print "\nBundle adjustment took: %s seconds\nElapsed Time: %s\n" %(bundle_t, current_time-t)
 
-manager.open_result()
+metrics.images = manager.image_metrics()
+metrics_fn = metrics.write()
 
-print "\nTiming Report:\n\
-		\tPrepare Photos: %s\n\
-		\tBundle Adjustment: %s\n\
-		\tTotal Elapsed Time: %s\n" %(prep_t, bundle_t, current_time-t)
+manager.open_result()
 
+print "\nMetrics Report (see %s):\n%s\n\
+		\tTotal Elapsed Time: %s\n" %(metrics_fn, metrics.report(), current_time-t)
@@ -1,5 +1,6 @@
 import logging
 import bundle_methods
+from bundle_methods.metrics import Metrics
 from time import time
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
@@ -9,18 +10,18 @@ t = time()
 
 manager = bundle_methods.Bundler()
 
-start_time = time()
+# time, memory, I/O and output counts of every stage (see bundle_methods/metrics.py)
+metrics = Metrics(manager.sfm_path, "ReRunBundler", t)
 
 # only run bundler with given list of images and key list 
-manager.re_run_bundle_adjustment()
+metrics.timed("Bundle Adjustment", manager.profiler.stage("re_run_bundle_adjustment", manager.re_run_bundle_adjustment),
+	lambda: manager.stage_counts("rerun"))()
 
 current_time = time()
-bundle_t = current_time-start_time
-print "\nBundle adjustment took: %s seconds\nElapsed Time: %s\n" %(bundle_t, current_time-t)
 
-manager.open_result()
+metrics_fn = metrics.write()
 
-print "\nTiming Report:\n\
-		\tBundle Adjustment: %s\n\
-		\tTotal Elapsed Time: %s\n" %(bundle_t, current_time-t)
+manager.open_result()
 
+print "\nMetrics Report (see %s):\n%s\n\
+		\tTotal Elapsed Time: %s\n" %(metrics_fn, metrics.report(), current_time-t)
@@ -0,0 +1,12 @@
+import logging
+from bundle_methods.batch import Batch
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+# one RunBundler (& RunPMVS) process per data directory,
+# shortest sessions first within the core & memory budget
+manager = Batch()
+
+manager.run()
+
+manager.report()
@@ -1,5 +1,6 @@
 import logging
 import bundle_methods
+from bundle_methods.metrics import Metrics
 from time import time
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
@@ -9,35 +10,33 @@ t = time()
 
 manager = bundle_methods.Bundler()
 
-start_time = time()
+# time, memory, I/O and output counts of every stage (see bundle_methods/metrics.py)
+metrics = Metrics(manager.sfm_path, "RunBundler", t)
 
-manager.prepare_photos()
+# profiled with -pf (see bundle_methods/profiling.py)
+profile = manager.profiler.stage
 
-current_time = time()
-prep_t = current_time-start_time
-print "\nPrepare Photos & Feature Extraction took: %s seconds\nElapsed Time: %s\n" %(prep_t, current_time-t)
+def counts(name):
+	return lambda: manager.stage_counts(name)
 
-start_time = time()
+def match():
+	metrics.timed("Image Retrieval", profile("retrieve_pairs", manager.retrieve_pairs))()
+	metrics.timed("Match Features", profile("match_features", manager.match_features), counts("match"))()
+	metrics.timed("Verify Matches", profile("verify_matches", manager.verify_matches), counts("match"))()
+	metrics.timed("Filter Tracks", profile("filter_tracks", manager.filter_tracks), counts("match"))()
 
-manager.match_features()
+# stages completed by an earlier run in the SfM directory are skipped
+manager.run_stage("extract", metrics.timed("Prepare Photos", profile("prepare_photos", manager.prepare_photos), counts("extract")))
+manager.run_stage("match", match)
+manager.run_stage("bundle", metrics.timed("Bundle Adjustment", profile("run_bundle_adjustment", manager.run_bundle_adjustment), counts("bundle")))
+manager.run_stage("undistort", metrics.timed("Undistort Photos", profile("undistort_photos", manager.undistort_photos)))
 
 current_time = time()
-match_t = current_time-start_time
-print "\nPairwise Feature matching took: %s seconds\nElapsed Time: %s\n" %(match_t, current_time-t)
-
-start_time = time()
 
-manager.run_bundle_adjustment()
-
-current_time = time()
-bundle_t = current_time-start_time
-print "\nBundle adjustment took: %s seconds\nElapsed Time: %s\n" %(bundle_t, current_time-t)
+metrics.images = manager.image_metrics()
+metrics_fn = metrics.write()
 
 manager.open_result()
 
-print "\nTiming Report:\n\
-		\tPrepare Photos: %s\n\
-		\tMatch Features: %s\n\
-		\tBundle Adjustment: %s\n\
-		\tTotal Elapsed Time: %s\n" %(prep_t, match_t, bundle_t, current_time-t)
-
+print "\nMetrics Report (see %s):\n%s\n\
+		\tTotal Elapsed Time: %s\n" %(metrics_fn, metrics.report(), current_time-t)
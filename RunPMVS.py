@@ -1,16 +1,30 @@
 import logging
 import pmvs_methods
+from bundle_methods.metrics import Metrics
+from time import time
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 # initialize OsmPMVS manager class
+t = time()
 manager = pmvs_methods.Pmvs()
 
+# time, memory & I/O of every stage (see bundle_methods/metrics.py)
+metrics = Metrics(manager.workDir, "RunPMVS", t)
+
 # initialize PMVS input from Bundler output
-manager.doBundle2PMVS()
+# (stages completed by an earlier run are skipped)
+# (profiled with -pf, see bundle_methods/profiling.py)
+manager.runStage("bundle2pmvs", metrics.timed("Bundle2PMVS", manager.profiler.stage("bundle2pmvs", manager.doBundle2PMVS)))
 
 # call PMVS
-manager.doPMVS()
+manager.runStage("pmvs", metrics.timed("PMVS", manager.profiler.stage("pmvs", manager.doPMVS)))
+
+current_time = time()
+metrics_fn = metrics.write()
 
 # show the Result
-manager.openResult()
\ No newline at end of file
+manager.openResult()
+
+print "\nMetrics Report (see %s):\n%s\n\
+		\tTotal Elapsed Time: %s\n" %(metrics_fn, metrics.report(), current_time-t)
@@ -0,0 +1,13 @@
+import logging
+from bundle_methods.keyframes import KeyframeSelector
+from time import time
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+t = time()
+
+# score frames of world.avi and write keyframes.npy & otherframes.npy
+manager = KeyframeSelector()
+manager.run()
+
+print "\nKeyframe selection took: %s seconds\n" %(time()-t)
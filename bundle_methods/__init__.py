@@ -1,19 +1,26 @@
-import sys, os, argparse, tempfile, subprocess
-from threading import Thread
+import sys, os, argparse, tempfile, subprocess, shutil
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from threading import Semaphore, Event
 import numpy as np
 
-import sqlite3
-
-from PIL import Image
-from PIL.ExifTags import TAGS
-
 import defaults
+import photos
+import keyframes
+import retrieval
+from stages import StageLog
+import profiling
+from cameras import sensors
 
 import matching
 from matching import *
 
 import features
 from features import *
+from features.cache import FeatureCache
+from features import container
+from matching.store import MatchStore
+from matching import verify, tracks, stream
 
 distrPath = os.path.dirname( os.path.abspath(sys.argv[0]) )
 
@@ -23,57 +30,83 @@ else: bundlerExecutable = os.path.join(distrPath, "software/bundler/bin_dev/bund
 
 RadialUndistordExecutable = os.path.join(distrPath, "software/bundler/bin_dev/RadialUndistort")
 
-SCALE = 1.0
 bundler_list_fn = "list.txt"
 bundler_list_add_fn = "add_list.txt"
+candidate_pairs_fn = "candidate_pairs.txt"
+verification_report_fn = "verification.txt"
+tracks_report_fn = "tracks.txt"
+stages_fn = "stages.json"
+stream_matches_fn = "matches.stream.txt"
 
 CAMERA_DB = os.path.join(distrPath, "bundle_methods/cameras/cameras.sqlite")
-EXIF_ATTRS = dict(Model=True,Make=True,ExifImageWidth=True,ExifImageHeight=True,FocalLength=True)
 
 
 class Bundler(object):
-	"""Multithreaded Bundler Pipeline
+	"""Multiprocess Bundler Pipeline
 		INPUT: Directory with .jpg photos to be used for Bundler
 		OUTPUT: Bundler reconstruction in tempfile Directory
 
 		Steps:
 		+ Parse Command Line Flags and set these variables to the object
-		******* To do in multiple threads ******
-		+ Process Photos: 
-			- make copy of image in pgm format for SIFT
+		******* Stages (RunBundler: extract, match, bundle, undistort) ******
+		+ A stage completed by an earlier run in the SfM directory is skipped
+			while its inputs, outputs and options are unchanged (see stages.py)
+		******* To do in a pool of worker processes (or threads) ******
+		+ Process Photos (see photos.py): 
+			- make copy of image in pgm format for SIFT (in memory by default)
 			- Extract exif data from photos
-			- Look up camera in database for sensor type
+			- Return exif data with the photo info
+		+ Feature detection
+			- Detect Features with specified engine
+			- Append features to the feature container of the SfM directory
+				(features.keypoints, features.descriptors), by image name
+				eg. 00000001
+			- Return feature_list entry with image name and keypoint file name
+		+ Match Features while extracting (optional, -st, see matching/stream.py)
+			- Match the candidate pairs of every extracted photo whose other
+				photo is extracted as well, in the same pool
+		******* Stop worker processes, collect results ******
+		+ Focal lengths (one pass over all photos):
+			- Look up cameras in the in-memory sensor index (cameras/sensors.py)
 			- Calculate focal length in pixels
-			- Append photo_list with image names and focal lengths
+			- Make photo_list with image names and focal lengths
 				[(photoname.jpg, 0, focal_length_pixels),(..,..,..)...] 
 				eg: ["000001.jpg", 0, 524.2]
-		+ Feature detection
-			- Detect Features with specified engine
-			- Save features to .key file using image name as file names
-				eg. 00000001.jpg.key 
-			- append feature_list with image names and keypoint file names
-		******* Stop Multithread processes ******
 		+ File I/O
 			- Write list.txt with sorted photo_list
 			- Write list_features.txt with sorted feature_list
+		+ Retrieve Pairs (optional, -r)
+			- Choose the photo pairs to match with a vocabulary tree
 		+ Match Features
-			- Match features with matching engine
+			- Match features with matching engine (or use the matches of -st)
+		+ Verify Matches (optional, -gv)
+			- Remove outlier matches & pairs with RANSAC
+		+ Filter Tracks (optional, -tl)
+			- Keep the matches of consistent tracks seen in enough photos
 		+ Run Bundler
+			- Export Lowe .key files of the photos from the feature container
 			- Using list.txt and options.txt as options file 
 	"""
 	def __init__(self):
 		self.currentDir = os.getcwd()
-		self.matching_engine = "bundler"
 
 		self.photo_list = [] # list to store photo file names & focal lengths
 		self.feature_list = [] # list to store keypoint file names 
 		self.photo_dict = {}
 
 		self.parse_command_line()
+		# absolute paths, photo workers never depend on the working directory
+		self.data_in = os.path.abspath(self.data_in)
 		self.sfm_path = os.path.join(self.data_in, "SfM")
-		if not self.add_photos:
+		if not self.add_photos and not os.path.isdir(self.sfm_path):
 			os.mkdir(self.sfm_path)
+		# completed stages of earlier runs in the SfM directory are skipped
+		self.stages = StageLog(os.path.join(self.sfm_path, stages_fn), self.force_stages)
+		# stages are profiled with -pf or PUPIL3D_PROFILE (see profiling.py)
+		self.profiler = profiling.Profiler(profiling.profile_dir(self.profile),
+			os.path.splitext(os.path.basename(sys.argv[0]))[0])
 		self.src_imgs_path = os.path.join(self.data_in, "src_imgs")
+		self.video_path = os.path.join(self.data_in, "world.avi")
 		self.load_data() 
 
 
@@ -89,8 +122,12 @@ class Bundler(object):
 			help='A directory that contains a folder called "src_imgs" (Required).',
 			required=True)
 		parser.add_argument('-t', '--num_threads', type=int, 
-			help='Set number of threads to use for image processing and feature detection/extraction.  Default = 8', 
+			help='Set number of workers to use for image processing, feature detection/extraction and feature matching.  Default = 8', 
 			default=8)
+		parser.add_argument('-p', '--pool', type=str,
+			help="Run image processing and feature extraction in a pool of processes or threads. Default = 'process'.",
+			choices=['process', 'thread'],
+			default='process')
 		parser.add_argument('-v', '--verbose', type=bool, 
 			help='Set to True for verbose dialogue', default=False)
 
@@ -99,15 +136,80 @@ class Bundler(object):
 			default=1280)
 		parser.add_argument('-f', '--feature_engine', type=str,
 			help="Specify feature detection engine (as string). Default = 'siftvlfeat'.",
-			choices=['siftvlfeat', 'sift', 'siftlowe', 'surfcv'],
+			choices=['siftvlfeat', 'sift', 'siftlowe', 'surfcv', 'klt'],
 			default='siftvlfeat')
 		
+		parser.add_argument('-m', '--matching_engine', type=str,
+			help="Specify feature matching engine (as string): 'bundler' runs KeyMatchFull on shards of the photo list in -t processes, 'native' matches all pairs in Python in a pool of -t processes, 'sequential' matches video frames with the following frames only (see -mw, -ls), 'klt' tracks the corners of -f klt through world.avi to the following -mw keyframes. Default = 'bundler'.",
+			choices=['bundler', 'native', 'sequential', 'klt'],
+			default='bundler')
+		parser.add_argument('-mw', '--match_window', type=int,
+			help="With -m sequential or klt: match every frame with this number of following frames. Default = 10.",
+			default=10)
+		parser.add_argument('-ls', '--loop_stride', type=int,
+			help="With -m sequential: match every n-th frame with earlier n-th frames to close loops, 0 to disable. Default = 10.",
+			default=10)
+		parser.add_argument('-lc', '--loop_candidates', type=int,
+			help="With -m sequential: number of earlier n-th frames (see -ls), spread evenly over the time before it, every n-th frame is matched with. Default = 8.",
+			default=8)
+
+		parser.add_argument('-mm', '--match_memory', type=int,
+			help="With -m native or sequential: memory in MB for the descriptors held by all matching workers together, pairs are matched in tiles that fit. Default = 4096.",
+			default=4096)
+		parser.add_argument('-ms', '--match_store', type=str,
+			help="With -m native or sequential: directory of the persistent store of pairwise matches, pairs found in it are not matched again. Set to 'none' to disable. Default = '~/.pupil3d/match_store'.",
+			default='~/.pupil3d/match_store')
+		parser.add_argument('-gv', '--verify', type=str,
+			help="Verify the matches of every photo pair with RANSAC using a 'fundamental' matrix or a 'homography' before bundle adjustment, 'none' to skip. Default = 'none'.",
+			choices=['none', 'fundamental', 'homography'],
+			default='none')
+		parser.add_argument('-gt', '--verify_threshold', type=float,
+			help="With -gv: maximum error of an inlier match in pixels. Default = 4.0.",
+			default=4.0)
+		parser.add_argument('-tl', '--min_track_length', type=int,
+			help="Build tracks from the matches before bundle adjustment and keep only the matches of consistent tracks seen in at least this number of photos. Default = 0, keep all matches.",
+			default=0)
+		parser.add_argument('-st', '--stream', type=bool,
+			help="Set to True to match the photo pairs while the features are extracted, in the same pool of workers (needs -m native or sequential, can't be combined with -r or -add). Default = False.",
+			default=False)
+		parser.add_argument('-r', '--retrieval_pairs', type=int,
+			help="Match every photo only with the photos most similar to it, this number of them, found with a vocabulary tree (needs -m native or sequential). Default = 0, match all pairs.",
+			default=0)
+
+		parser.add_argument('-io', '--feature_io', type=str,
+			help="Hand grayscale images to the feature engine in memory ('pipe') or as .pgm files in the working directory ('file'). Default = 'pipe'.",
+			choices=['pipe', 'file'],
+			default='pipe')
+		parser.add_argument('-c', '--feature_cache', type=str,
+			help="Directory of the persistent feature cache, shared by all feature engines. Set to 'none' to disable. Default = '~/.pupil3d/feature_cache'.",
+			default='~/.pupil3d/feature_cache')
+		parser.add_argument('-cs', '--feature_cache_size', type=int,
+			help="Maximum size of the feature cache in MB, least recently used features are removed first. Default = 2048.",
+			default=2048)
+
+		parser.add_argument('-src', '--source', type=str,
+			help="Read the frames from the .jpg files in src_imgs ('images') or decode them from world.avi ('video'). Default = 'images'.",
+			choices=['images', 'video'],
+			default='images')
+		parser.add_argument('-k', '--num_keyframes', type=int,
+			help="If there is no keyframes.npy, select this number of keyframes from world.avi (see SelectKeyframes.py). Default = use all frames in src_imgs.",
+			default=None)
+
 		parser.add_argument('-add', '--add_photos', type=bool, 
 			help='Set to True to add images to existing bundler reconstruction. User working directory must be specified (-wd flag).', 
 			default=False)
 		parser.add_argument('-rr', '--re_run', type=bool, 
 			help='Set to True to run bundler only.  User working directory must be specified (-wd flag).', 
 			default=False)	
+		parser.add_argument('-fs', '--force_stages', type=bool,
+			help="Set to True to run all stages again. By default the stages completed by an earlier run in the SfM directory are skipped while their inputs, outputs and options are unchanged (see SfM/%s)." % stages_fn,
+			default=False)
+		parser.add_argument('-nw', '--no_window', type=bool,
+			help="Set to True to not open the result in a file browser at the end (batch runs, see RunBatch.py).",
+			default=False)
+		parser.add_argument('-pf', '--profile', type=str,
+			help="Profile every stage (cProfile, sampled stacks for flamegraphs, allocation sites) into this directory, see bundle_methods/profiling.py. Default = $%s, no profiling if unset." % profiling.PROFILE_ENV,
+			default=None)
 
  		try:
 			args = parser.parse_args(namespace=self)						
@@ -129,54 +231,139 @@ class Bundler(object):
 			try:
 				self.otherframes = np.load("otherframes.npy")
 			except:
-				print "No otherframes.npy file found... using all the frames in src_imgs/."
+				print "No otherframes.npy file found... using all the frames in %s." %(self.source_name())
 				self.otherframes = None
 
 			if self.otherframes is not None:
 				otherframe_strings =  ["%08d.jpg" %i for i in self.otherframes]
 				self.photos = otherframe_strings
 			else: 
-				self.photos =[f for f in os.listdir("src_imgs") if os.path.isfile(os.path.join("src_imgs", f)) and os.path.splitext(f)[1].lower()==".jpg"]
+				self.photos = self.all_frames()
 
 		else:
 			try:
 				self.keyframes = np.load("keyframes.npy")
 			except:
-				print "No keyframes.npy file found... using all the frames in src_imgs/."
 				self.keyframes = None
+				if self.num_keyframes and os.path.isfile("world.avi"):
+					print "No keyframes.npy file found... selecting %s keyframes from world.avi." %(self.num_keyframes)
+					scores = keyframes.score_video(os.path.join(self.data_in, "world.avi"), self.num_threads)
+					self.keyframes = keyframes.select_keyframes(scores, self.num_keyframes)
+					keyframes.save_frames(self.data_in, self.keyframes, keyframes.select_otherframes(scores, self.keyframes))
+				else:
+					print "No keyframes.npy file found... using all the frames in %s." %(self.source_name())
 
 			if self.keyframes is not None:
 				keyframe_strings =  ["%08d.jpg" %i for i in self.keyframes]
 				self.photos = keyframe_strings
 			else: 
-				self.photos =[f for f in os.listdir("src_imgs") if os.path.isfile(os.path.join("src_imgs", f)) and os.path.splitext(f)[1].lower()==".jpg"]
+				self.photos = self.all_frames()
 		os.chdir(self.currentDir)
 
+	def source_name(self):
+		return "world.avi" if self.source == "video" else "src_imgs/"
 
-	def chunk_list(self, l, n):
-		threads = [[] for i in range(n)]
-		i = 0
-		for i in range(n):
-			threads[i] = l[i::n]
-			i += 1
-		return threads
-
-	def prepare_photos(self):
-		thread_list = []
-		
-		# split the list of photos into chunks based on how many threads we want to run
-		self.photos_chunk_list = self.chunk_list(self.photos, self.num_threads)
-		# make threads for each chunk and process photos
-		for th in xrange(0, self.num_threads):
-			thread_list.append( Thread(target=self.process_photos, args=([self.photos_chunk_list[th]]) ))	
+	def all_frames(self):
+		# photo names of all the frames of the source
+		if self.source == "video":
+			return ["%08d.jpg" %i for i in xrange(photos.video_frame_count(self.video_path))]
+		return [f for f in os.listdir(self.src_imgs_path) if os.path.isfile(os.path.join(self.src_imgs_path, f)) and os.path.splitext(f)[1].lower()==".jpg"]
 
-		os.chdir(self.sfm_path)
 
-		for th in thread_list:
-			th.start()
+	def prepare_photos(self):
+		# process the photos in a pool of workers (processes by default)
+		# each worker returns its results, which are collected here
+		if self.stream:
+			if not hasattr(self.matching_engine, "settings"):
+				raise Exception, "Streaming (-st) needs a matching engine that matches in Python (-m native or -m sequential)"
+			if self.retrieval_pairs or self.add_photos:
+				raise Exception, "Streaming (-st) can't be combined with image retrieval (-r) or added photos (-add), they need the features of all photos"
+		if self.feature_cache.lower() != "none":
+			feature_cache = FeatureCache(self.feature_cache, self.feature_cache_size)
+		else:
+			feature_cache = None
 
-		for th in thread_list:
-			th.join()
+		# workers append the features of every photo to the container of the SfM directory,
+		# which starts empty unless photos are added
+		container_prefix = os.path.join(self.sfm_path, container.CONTAINER_PREFIX)
+		if not self.add_photos:
+			for fn in container.container_files(container_prefix):
+				if os.path.exists(fn):
+					os.remove(fn)
+		settings = dict(src_imgs_path=self.src_imgs_path, sfm_path=self.sfm_path, 
+						max_size=self.max_size,
+						feature_engine=self.feature_engine, feature_cache=feature_cache,
+						feature_io=self.feature_io, verbose=self.verbose,
+						container=container_prefix, container_lock=multiprocessing.Lock())
+		if self.pool == "process":
+			pool = multiprocessing.Pool(self.num_threads, photos.init_worker, (settings,))
+		else:
+			pool = ThreadPool(self.num_threads, photos.init_worker, (settings,))
+
+		if self.source == "video":
+			# frames are decoded from the video by a producer feeding the pool,
+			# with at most 2 frames per worker waiting to be processed
+			slots, stop = Semaphore(2*self.num_threads), Event()
+			jobs = photos.video_frames(self.video_path, self.photos, slots, stop)
+			worker = photos.process_frame
+		elif self.stream:
+			# photos are handed out a few at a time, so match jobs don't queue behind all of them
+			slots, stop = Semaphore(2*self.num_threads), Event()
+			jobs = photos.bounded_jobs(self.photos, slots, stop)
+			worker = photos.process_photo
+		else:
+			slots = None
+			jobs = self.photos
+			worker = photos.process_photo
+
+		matcher = None
+		if self.stream:
+			# photo j of the features list is matched with photo i > j, as by the matching engine
+			key_files = sorted(os.path.join(self.sfm_path, "%s.%s" %(p[:-4], self.feature_engine.fileExtension))
+				for p in self.photos)
+			matcher = stream.StreamMatching(pool, container_prefix, key_files, self.matching_engine)
+
+		index_entries = []
+		try:
+			for feature_entry, photo_info in pool.imap_unordered(worker, jobs):
+				if slots is not None:
+					slots.release()
+				self.feature_list.append(feature_entry)
+				index_entries.append((feature_entry[0],) + photo_info['rows'] + (0,))
+				self.photo_dict[photo_info['basename']] = photo_info
+				if matcher is not None:
+					matcher.add(feature_entry[0], photo_info['rows'])
+			if matcher is not None:
+				matched = matcher.finish()
+		except:
+			if slots is not None:
+				# unblock the producer
+				stop.set()
+				slots.release()
+			pool.terminate()
+			raise
+		pool.close()
+		pool.join()
+
+		# the rows of the photos in the container, written once
+		container.update_index(container_prefix, index_entries)
+
+		if matcher is not None:
+			matching.native.write_match_table(os.path.join(self.sfm_path, stream_matches_fn), matched)
+			print "\nStreaming matches: %s of %s photo pairs with at least %s matches (see %s)\n" %(
+				len(matched), matcher.num_pairs, self.matching_engine.min_matches, stream_matches_fn)
+
+		# focal lengths in pixels of all photos in one pass
+		sensor_index = sensors.get_index(CAMERA_DB)
+		self.photo_list.extend(photos.focal_length_entries(self.photo_dict.values(), sensor_index, self.verbose))
+
+		if feature_cache is not None:
+			hits = len([i for i in self.photo_dict.values() if i['cached']])
+			evicted = feature_cache.evict()
+			print "\nFeature cache report (%s):\n\
+		\tHits: %s\n\
+		\tMisses: %s\n\
+		\tEvicted: %s\n" %(feature_cache.cache_dir, hits, len(self.photo_dict)-hits, evicted)
 
 		# write the necessary output files
 		# photo_list and feature_list
@@ -199,107 +386,19 @@ class Bundler(object):
 		bundler_list_file.close()
 		feature_list_file.close()
 
-		os.chdir(self.currentDir)
-
-
-
-
-	def process_photos(self, photos):
-		for p in photos:
-			if self.verbose:
-				print "\nProcessing Photo '%s':" %p
-
-			photo_info = dict(dirname=self.src_imgs_path, basename=p)
-			src_jpg_in = os.path.join(self.src_imgs_path, p)
-
-			# make file paths for output into working directory
-			jpg_out = os.path.join(self.sfm_path, p)
-			pgm_out = "%s.pgm" % os.path.join(self.sfm_path, p)
-
-			# now we open the image using PIL and get exif data
-			p_obj = Image.open(src_jpg_in)
-			exif = self.get_exif(p_obj)
-			self.calc_focal_length_pixels(p_obj, photo_info, exif)
-
-
-			# resize photo if necessary
-			max_dim = max(p_obj.size)
-			if max_dim > self.max_size:
-				scale = float(self.max_size)/float(max_dim)
-				new_width = int(scale * p_obj.size[0])
-				new_height = int(scale * p_obj.size[1])
-				p_obj = p_obj.resize((new_width, new_height))
-				if self.verbose:
-					print "\tCopy of the photo has been scaled down to %sx%s" %(new_width,new_height)
-			
-			photo_info['width'] = p_obj.size[0]
-			photo_info['height'] = p_obj.size[1]
-			
-			p_obj.save(jpg_out)
-			p_obj.convert("L").save(pgm_out)
-
-			self.photo_dict[p] = photo_info
-
-			# extract feature keypoints
-			self.extract_features(p)
-			os.remove(pgm_out)
-
-
-
-	def get_exif(self, p_obj):
-		# helper function to extract exif data from .jpgs
-		exif = {}
-		info = p_obj._getexif()
-		if info:
-			for attr, value in info.items():
-				decoded_attr = TAGS.get(attr, attr)
-				if decoded_attr in EXIF_ATTRS:
-					exif[decoded_attr] = value
-		if 'FocalLength' in exif: 
-			exif['FocalLength'] = float(exif['FocalLength'][0])/float(exif['FocalLength'][1])
-			if self.verbose: print "exif['FocalLength']: \t", exif['FocalLength']
-		
-		return exif
-
-	def calc_focal_length_pixels(self, p_obj, photo_info, exif):
-		conn = sqlite3.connect(CAMERA_DB)
-		dbCursor = conn.cursor()
-		if 'Make' in exif and 'Model' in exif:
-			# check if have camera entry in the database by make/model taken from exif
-			dbCursor.execute("select ccd_width from cameras where make=? and model=?", (exif['Make'].strip(),exif['Model'].strip()))
-			ccdWidth = dbCursor.fetchone()
-			if ccdWidth:
-				if 'FocalLength' in exif and 'ExifImageWidth' in exif and 'ExifImageHeight' in exif:
-					focalLength = float(exif['FocalLength'])
-					width = float(exif['ExifImageWidth'])
-					height = float(exif['ExifImageHeight'])
-					if self.verbose: print "\nphoto: %s, width %s, height: %s, focal_length: %s" %(p_obj, width, height, focalLength)
-
-					if focalLength>0 and width>0 and height>0:
-						if width<height: width = height
-						focalPixels = width * (focalLength / ccdWidth[0])
-						#
-						self.photo_list.append((photo_info['basename'],0,SCALE*focalPixels))
-
-						if self.verbose:
-							print "\nAdded image %s to the photo_list with focal length: %s" \
-									%(photo_info['basename'], SCALE*focalPixels)
-						#self.bundlerListFile.write("%s.jpg 0 %s\n" % (p_obj,SCALE*focalPixels))
-			else: 
-				if self.verbose: 
-					print "\tEntry for the camera '%s', '%s' does not exist in the camera database" % (exif['Make'], exif['Model'])
-		if 'FocalLength' not in exif:
-			if self.verbose: 
-				print "\tCan't estimate focal length in pixels for the photo '%s'" % os.path.join(p_obj_info['dirname'],p_obj_info['basename'])
-			self.photo_list.append((photo_info['basename'],0,' '))
-
-		dbCursor.close()
-
 	def init_matching_engine(self):
 		try:
 			matching_engine = getattr(matching, self.matching_engine)
 			matching_engine_class = getattr(matching_engine, matching_engine.className)
 			self.matching_engine = matching_engine_class(os.path.join(distrPath, "software"))
+			self.matching_engine.num_workers = self.num_threads
+			self.matching_engine.window = self.match_window
+			self.matching_engine.loop_stride = self.loop_stride
+			self.matching_engine.loop_candidates = self.loop_candidates
+			self.matching_engine.memory_budget_mb = self.match_memory
+			self.matching_engine.video_path = self.video_path
+			if self.match_store.lower() != "none":
+				self.matching_engine.match_store = MatchStore(self.match_store)
 		except:
 			raise Exception, "Unable initialize matching engine %s" % self.matching_engine
 
@@ -314,21 +413,181 @@ class Bundler(object):
 		except:
 			raise Exception, "Unable initialize feature extractor %s" %self.feature_engine
 
-	def extract_features(self, photo):
-		self.feature_engine.extract(photo, self.photo_dict[photo])
-		self.feature_list.append((photo[:-4], self.feature_engine.fileExtension))
+	def stage_files(self, name):
+		"""(inputs, outputs, params) of a stage of RunBundler, see stages.py
+			paths are relative to the SfM directory
+		"""
+		features = [os.path.basename(fn) for fn in container.container_files(container.CONTAINER_PREFIX)]
+		features_list = self.matching_engine.featuresListFileName
+		match_table = self.matching_engine.outputFileName
+		if name == "extract":
+			outputs = [bundler_list_fn, features_list] + features
+			params = dict(photos=sorted(self.photos), max_size=self.max_size, source=self.source,
+				feature_engine=self.feature_engine.cache_key(), stream=self.stream)
+			if self.stream:
+				outputs.append(stream_matches_fn)
+				params.update(matching_engine=self.matching_engine.__class__.__name__,
+					match_window=self.match_window, loop_stride=self.loop_stride, loop_candidates=self.loop_candidates)
+			return ([os.path.join(self.data_in, self.source_name()), os.path.join(self.data_in, "keyframes.npy")],
+				outputs, params)
+		if name == "match":
+			inputs = [features_list] + features
+			if self.stream:
+				inputs.append(stream_matches_fn)
+			return (inputs, [match_table],
+				dict(matching_engine=self.matching_engine.__class__.__name__, match_window=self.match_window,
+					loop_stride=self.loop_stride, loop_candidates=self.loop_candidates, retrieval_pairs=self.retrieval_pairs, verify=self.verify,
+					verify_threshold=self.verify_threshold, min_track_length=self.min_track_length))
+		if name == "bundle":
+			return ([bundler_list_fn, features_list, match_table] + features, ["bundle"],
+				dict(options=list(defaults.bundlerOptions)))
+		if name == "undistort":
+			return ([bundler_list_fn, "bundle/bundle.out"], ["undistorted_imgs"], {})
+		raise Exception, "Unknown stage '%s'" % name
+
+	def run_stage(self, name, func):
+		# run func as the stage name, unless it is up to date
+		inputs, outputs, params = self.stage_files(name)
+		return self.stages.run(name, func, inputs, outputs, params)
+
+	def stage_counts(self, name):
+		"""Counts of the outputs of a stage of RunBundler, for the metrics (see metrics.py)"""
+		if name == "extract":
+			index = container.read_index(os.path.join(self.sfm_path, container.CONTAINER_PREFIX))
+			return dict(photos=len(index), features=sum(count for row, count, mtime in index.values()))
+		if name == "match":
+			match_table = os.path.join(self.sfm_path, self.matching_engine.outputFileName)
+			if not os.path.exists(match_table):
+				return {}
+			counts = [count for j, i, count in matching.native.read_match_counts(match_table)]
+			return dict(pairs=len(counts), matches=sum(counts))
+		if name in ("bundle", "rerun"):
+			bundle_fn = os.path.join(self.sfm_path, "bundle_rerun" if name == "rerun" else "bundle", "bundle.out")
+			if not os.path.exists(bundle_fn):
+				return {}
+			f = open(bundle_fn, "r")
+			f.readline() # "# Bundle file v0.3"
+			num_cameras, num_points = [int(v) for v in f.readline().split()]
+			# 5 lines per camera, the focal length of cameras that are not registered is 0
+			registered = 0
+			for n in xrange(num_cameras):
+				registered += float(f.readline().split()[0]) != 0
+				for l in xrange(4):
+					f.readline()
+			f.close()
+			return dict(cameras=num_cameras, registered=registered, points=num_points)
+		return {}
+
+	def image_metrics(self):
+		"""Features, extraction time & matches of every photo of the feature lists, for the metrics"""
+		key_files = []
+		for fn in (self.matching_engine.featuresListFileName, self.matching_engine.features_list_add_fn):
+			if os.path.exists(os.path.join(self.sfm_path, fn)):
+				f = open(os.path.join(self.sfm_path, fn), "r")
+				key_files.extend(l.strip() for l in f if l.strip())
+				f.close()
+		names = [container.image_name(fn) for fn in key_files]
+		index = container.read_index(os.path.join(self.sfm_path, container.CONTAINER_PREFIX))
+		images = [dict(photo=name, features=index[name][1] if name in index else 0, pairs=0, matches=0) for name in names]
+
+		match_table = os.path.join(self.sfm_path, self.matching_engine.outputFileName)
+		if os.path.exists(match_table):
+			for j, i, count in matching.native.read_match_counts(match_table):
+				for n in (j, i):
+					if n < len(images):
+						images[n]['pairs'] += 1
+						images[n]['matches'] += count
+
+		for image in images:
+			photo_info = self.photo_dict.get(image['photo'] + ".jpg")
+			if photo_info is not None:
+				for key in ('extract_seconds', 'extract_cpu_seconds', 'cached'):
+					image[key] = photo_info[key]
+		return images
+
+	def retrieve_pairs(self):
+		# choose the photo pairs to match with image retrieval (-r)
+		if not self.retrieval_pairs:
+			return
+		if not hasattr(self.matching_engine, "candidate_pairs"):
+			raise Exception, "Image retrieval (-r) needs a matching engine that matches selected pairs (-m native or -m sequential)"
+		features_list = open(os.path.join(self.sfm_path, self.matching_engine.featuresListFileName), "r")
+		key_files = [os.path.join(self.sfm_path, l.strip()) for l in features_list if l.strip()]
+		features_list.close()
+
+		pairs = retrieval.retrieve_pairs(key_files, self.retrieval_pairs, self.num_threads)
+		pairs_fn = os.path.join(self.sfm_path, candidate_pairs_fn)
+		retrieval.write_pairs(pairs_fn, pairs)
+		self.matching_engine.candidatePairsFileName = pairs_fn
+		total = len(key_files)*(len(key_files)-1)/2
+		print "\nImage retrieval: %s of %s photo pairs to match\n" %(len(pairs), total)
 
 	def match_features(self):
+		# the pairs were matched while the features were extracted (-st)
+		if self.stream:
+			shutil.copyfile(os.path.join(self.sfm_path, stream_matches_fn),
+				os.path.join(self.sfm_path, self.matching_engine.outputFileName))
+			return
 		# let self.matchingEngine do its job
 		os.chdir(self.sfm_path)
 		self.matching_engine.match()
 		os.chdir(self.currentDir)
 
+	def verify_matches(self):
+		# geometric verification of the match table (-gv)
+		if self.verify == "none":
+			return
+		kept, total = verify.verify_match_table(
+			os.path.join(self.sfm_path, self.matching_engine.featuresListFileName),
+			os.path.join(self.sfm_path, self.matching_engine.outputFileName),
+			os.path.join(self.sfm_path, verification_report_fn),
+			self.verify, self.verify_threshold, num_workers=self.num_threads)
+		print "\nGeometric verification: kept %s of %s photo pairs (see %s)\n" %(kept, total, verification_report_fn)
+
+	def filter_tracks(self):
+		# keep the matches of consistent, long enough tracks (-tl)
+		if self.min_track_length <= 0:
+			return
+		stats = tracks.filter_match_table(
+			os.path.join(self.sfm_path, self.matching_engine.outputFileName),
+			os.path.join(self.sfm_path, tracks_report_fn),
+			self.min_track_length)
+		print "\nTrack report (see %s):\n\
+		\tTracks: %s\n\
+		\tConsistent: %s\n\
+		\tKept (length >= %s): %s, mean length %.2f\n\
+		\tPhoto pairs: %s of %s\n\
+		\tMatches: %s of %s\n" %(tracks_report_fn, stats['tracks'], stats['consistent'], self.min_track_length,
+			stats['kept'], stats['mean_length'], stats['kept_pairs'], stats['pairs'], stats['kept_matches'], stats['matches'])
+
+	def match_added_features(self):
+		# match only the added photos (-add), the match table of the 
+		# reconstruction is kept and the new pairs are appended to it
+		if not hasattr(self.matching_engine, "match_added"):
+			print "\nThe matching engine can't match added photos, use -m native or -m sequential."
+			return
+		os.chdir(self.sfm_path)
+		self.matching_engine.match_added()
+		os.chdir(self.currentDir)
+
+	def export_key_files(self):
+		# Bundler & KeyMatchFull read Lowe key files, they are
+		# written from the feature container when needed
+		written = 0
+		for fn in (self.matching_engine.featuresListFileName, self.matching_engine.features_list_add_fn):
+			if os.path.exists(os.path.join(self.sfm_path, fn)):
+				written += container.export_lowe(os.path.join(self.sfm_path, container.CONTAINER_PREFIX),
+					os.path.join(self.sfm_path, fn), self.num_threads)
+		if written:
+			print "\nExported %s key files from the feature container" % written
+
 	def run_bundle_adjustment(self):
 		# just run Bundler here
 		print "\nPerforming bundle adjustment..."
+		self.export_key_files()
 		os.chdir(self.sfm_path)
-		os.mkdir("bundle")
+		if not os.path.isdir("bundle"):
+			os.mkdir("bundle")
 		
 		# create options.txt
 		optionsFile = open("options.txt", "w")
@@ -336,13 +595,22 @@ class Bundler(object):
 		optionsFile.close()
 
 		bundlerOutputFile = open("bundle/out", "w")
-		subprocess.call([bundlerExecutable, "list.txt", "--options_file", "options.txt"], **dict(stdout=bundlerOutputFile))
+		returncode = subprocess.call([bundlerExecutable, "list.txt", "--options_file", "options.txt"], **dict(stdout=bundlerOutputFile))
 		bundlerOutputFile.close()
+		os.chdir(self.currentDir)
+		# a failed stage is not recorded as completed
+		if returncode != 0:
+			raise Exception, "Bundler failed with exit code %s, see %s" %(returncode, os.path.join(self.sfm_path, "bundle/out"))
 
-		os.mkdir("undistorted_imgs")
-		subprocess.call([RadialUndistordExecutable, "list.txt", "bundle/bundle.out", "undistorted_imgs"])
+	def undistort_photos(self):
+		os.chdir(self.sfm_path)
+		if not os.path.isdir("undistorted_imgs"):
+			os.mkdir("undistorted_imgs")
+		returncode = subprocess.call([RadialUndistordExecutable, "list.txt", "bundle/bundle.out", "undistorted_imgs"])
 		
 		os.chdir(self.currentDir)
+		if returncode != 0:
+			raise Exception, "RadialUndistort failed with exit code %s" % returncode
 		print "Finished!"
 
 
@@ -350,6 +618,7 @@ class Bundler(object):
 		# we want to add to an existing bundle.out file
 		# therefore we will need a set of 
 		print "\nPerforming bundle adjustment..."
+		self.export_key_files()
 		os.chdir(self.sfm_path)
 		#os.mkdir("bundle_add")
 		
@@ -364,26 +633,33 @@ class Bundler(object):
 		os.chdir(self.currentDir)
 		print "Finished!"
 
-	# def re_run_bundle_adjustment(self):
-	# 	# rerun bundler to optimize 
-	# 	print "\nPerforming bundle adjustment..."
-	# 	os.chdir(self.sfm_path)
-	# 	os.mkdir("bundle_rerun")
+	def re_run_bundle_adjustment(self):
+		# rerun bundler to optimize, the result goes to bundle_rerun
+		print "\nPerforming bundle adjustment..."
+		self.export_key_files()
+		os.chdir(self.sfm_path)
+		if not os.path.isdir("bundle_rerun"):
+			os.mkdir("bundle_rerun")
 		
-	# 	# create options.txt
-	# 	optionsFile = open("options_rerun.txt", "w")
-	# 	optionsFile.writelines(defaults.bundler_rerun_options)
-	# 	optionsFile.close()
+		# create options.txt
+		optionsFile = open("options_rerun.txt", "w")
+		optionsFile.writelines(defaults.bundler_rerun_options)
+		optionsFile.close()
 
-	# 	bundlerOutputFile = open("bundle_rerun/out", "w")
-	# 	subprocess.call([bundlerExecutable, "list.txt", "--options_file", "options_rerun.txt"], **dict(stdout=bundlerOutputFile))
-	# 	bundlerOutputFile.close()
-	# 	os.chdir(self.currentDir)
-	# 	print "Finished!"
+		bundlerOutputFile = open("bundle_rerun/out", "w")
+		returncode = subprocess.call([bundlerExecutable, "list.txt", "--options_file", "options_rerun.txt"], **dict(stdout=bundlerOutputFile))
+		bundlerOutputFile.close()
+		os.chdir(self.currentDir)
+		if returncode != 0:
+			raise Exception, "Bundler failed with exit code %s, see %s" %(returncode, os.path.join(self.sfm_path, "bundle_rerun/out"))
+		print "Finished!"
 
 
 
 	def open_result(self):
+		if self.no_window:
+			print "See the results in the '%s' directory." %self.sfm_path
+			return
 		if sys.platform == "win32": 
 			subprocess.call(["explorer", self.sfm_path])
 		else: 
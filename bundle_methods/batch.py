@@ -0,0 +1,289 @@
+"""
+Batch runs of many recordings under a core & memory budget (RunBatch.py)
+
+Every data directory is a session: RunBundler (and RunPMVS with -pmvs)
+run in a child process of their own, with the data directory as working
+directory, so the chdir calls and module level paths of the pipeline
+never clash between sessions.  Their output goes to a log file per
+session and step in the report directory.
+
+Sessions are started shortest job first while they fit in the budget:
+	- a session takes -t cores (the workers of its pools)
+	- and the memory it needed in its last run (the metrics of the SfM
+		directory, see metrics.py: peak RSS of the main process plus -t
+		times the peak RSS of its largest child), -sm MB without metrics
+The length of a session is the total time of its last run as well, or
+estimated from the number of photos and photo pairs.  A session larger
+than the whole budget runs alone.
+
+The report directory gets batch.json and batch.csv with the wall & CPU
+time, peak RSS and exit code of every session, and the stage times of
+their metrics, and a throughput summary is printed.
+"""
+import os, sys, time, json, csv, shlex, argparse, subprocess
+import multiprocessing
+
+import numpy as np
+
+import photos
+from metrics import metrics_dir, maxrss_mb
+
+SECONDS_PER_PHOTO = 1.0
+SECONDS_PER_PAIR = 0.05
+
+def memory_total_mb():
+	"""Physical memory in MB, None if unknown"""
+	try:
+		f = open("/proc/meminfo", "r")
+	except IOError:
+		return None
+	for l in f:
+		if l.startswith("MemTotal:"):
+			f.close()
+			return int(l.split()[1]) / 1024.0
+	f.close()
+	return None
+
+def count_photos(data_in):
+	"""Number of photos RunBundler would process in data_in"""
+	if os.path.exists(os.path.join(data_in, "keyframes.npy")):
+		return len(np.load(os.path.join(data_in, "keyframes.npy")))
+	src_imgs = os.path.join(data_in, "src_imgs")
+	if os.path.isdir(src_imgs):
+		return len([f for f in os.listdir(src_imgs) if os.path.splitext(f)[1].lower() == ".jpg"])
+	if os.path.exists(os.path.join(data_in, "world.avi")):
+		return photos.video_frame_count(os.path.join(data_in, "world.avi"))
+	return 0
+
+def wait_any(sessions):
+	"""Wait for the process of one of the running sessions to end
+		OUTPUT: (session, resource usage of the process or None)
+	"""
+	if hasattr(os, "wait4"):
+		while True:
+			pid, status, rusage = os.wait4(-1, 0)
+			for session in sessions:
+				if session.process.pid == pid:
+					if os.WIFSIGNALED(status):
+						session.process.returncode = -os.WTERMSIG(status)
+					else:
+						session.process.returncode = os.WEXITSTATUS(status)
+					return session, rusage
+	# win32: no wait4
+	while True:
+		for session in sessions:
+			if session.process.poll() is not None:
+				return session, None
+		time.sleep(0.5)
+
+class Session(object):
+	def __init__(self, data_in, steps, threads, default_memory_mb):
+		"""data_in: data directory of the recording
+			steps: command lines run one after the other, with data_in as working directory
+		"""
+		self.data_in = os.path.abspath(data_in)
+		self.name = os.path.basename(self.data_in.rstrip(os.sep))
+		self.steps = steps
+		self.threads = threads
+		self.photos = count_photos(self.data_in)
+		self.process = None
+		# order in which the session started, numbers its logs
+		self.number = None
+		self.step = 0
+		self.log_fns = []
+		self.results = []
+		self.started = self.finished = None
+
+		last_run = self.last_metrics()
+		if last_run is not None:
+			self.estimate_seconds = last_run['total_seconds']
+			self.memory_mb = max([stage.get('peak_rss_mb') or 0 for stage in last_run['stages']] +
+				[0]) + threads * max([stage.get('children_peak_rss_mb') or 0 for stage in last_run['stages']] + [0])
+			self.estimated_from = "metrics"
+		else:
+			self.estimate_seconds = self.photos * SECONDS_PER_PHOTO + self.photos * (self.photos-1) / 2 * SECONDS_PER_PAIR
+			self.memory_mb = default_memory_mb
+			self.estimated_from = "photos"
+
+	def last_metrics(self):
+		fn = os.path.join(self.data_in, "SfM", metrics_dir, "RunBundler.json")
+		if not os.path.exists(fn):
+			return None
+		f = open(fn, "r")
+		try:
+			return json.load(f)
+		except ValueError:
+			return None
+		finally:
+			f.close()
+
+	def start_step(self, log_dir):
+		log_fn = os.path.join(log_dir, "%02d_%s_%d.log" %(self.number, self.name, self.step))
+		log = open(log_fn, "w")
+		self.process = subprocess.Popen(self.steps[self.step], cwd=self.data_in,
+			stdout=log, stderr=subprocess.STDOUT)
+		log.close()
+		self.log_fns.append(log_fn)
+		self.step_started = time.time()
+
+	def end_step(self, rusage):
+		result = dict(command=" ".join(self.steps[self.step]), returncode=self.process.returncode,
+			wall_seconds=time.time()-self.step_started)
+		if rusage is not None:
+			result['cpu_seconds'] = rusage.ru_utime + rusage.ru_stime
+			result['peak_rss_mb'] = maxrss_mb(rusage.ru_maxrss)
+		self.results.append(result)
+		self.step += 1
+		# the next step only runs if this one succeeded
+		return self.process.returncode == 0 and self.step < len(self.steps)
+
+	def summary(self):
+		failed = [r for r in self.results if r['returncode'] != 0]
+		summary = dict(session=self.name, data_in=self.data_in, photos=self.photos, threads=self.threads,
+			estimate_seconds=self.estimate_seconds, estimated_from=self.estimated_from, memory_mb=self.memory_mb,
+			wall_seconds=(self.finished or time.time()) - self.started if self.started else 0,
+			cpu_seconds=sum(r.get('cpu_seconds', 0) for r in self.results),
+			peak_rss_mb=max([r.get('peak_rss_mb', 0) for r in self.results] + [0]),
+			returncode=failed[0]['returncode'] if failed else 0, steps=self.results, logs=self.log_fns)
+		# stage times of the run, from its metrics
+		last_run = self.last_metrics()
+		if last_run is not None and self.results and not failed:
+			summary['stages'] = dict((stage['stage'], stage['wall_seconds']) for stage in last_run['stages'])
+		return summary
+
+class Batch(object):
+	"""Run RunBundler (& RunPMVS) for many data directories
+		INPUT: data directories of the recordings
+		OUTPUT: reconstructions in <data directory>/SfM, batch report
+	"""
+	def __init__(self):
+		self.currentDir = os.getcwd()
+		self.parse_command_line()
+		self.report_dir = os.path.abspath(self.report_dir)
+		if not os.path.isdir(self.report_dir):
+			os.makedirs(self.report_dir)
+		if self.memory is None:
+			total = memory_total_mb()
+			self.memory = 0.8 * total if total else float("inf")
+		self.threads = min(self.threads, self.cores)
+
+		distr_path = os.path.dirname(os.path.abspath(sys.argv[0]))
+		run_bundler = [sys.executable, os.path.join(distr_path, "RunBundler.py")]
+		run_pmvs = [sys.executable, os.path.join(distr_path, "RunPMVS.py")]
+		self.sessions = []
+		for data_in in self.data_dirs:
+			if not os.path.isdir(data_in):
+				raise Exception, "'%s' is not a directory.  Please give data directories with photos." % data_in
+			data_in = os.path.abspath(data_in)
+			steps = [run_bundler + ["-d", data_in, "-t", str(self.threads), "-nw", "1"] + shlex.split(self.bundler_args)]
+			if self.pmvs:
+				steps.append(run_pmvs + ["-d", os.path.join(data_in, "SfM"), "-nw", "1"] + shlex.split(self.pmvs_args))
+			self.sessions.append(Session(data_in, steps, self.threads, self.session_memory))
+
+	def parse_command_line(self):
+		parser = argparse.ArgumentParser(description="Run the SfM pipeline for many data directories at once.")
+		parser.add_argument('data_dirs', type=str, nargs='+',
+			help='Data directories, each with a folder called "src_imgs" or a world.avi (see RunBundler.py -d).')
+		parser.add_argument('-j', '--cores', type=int,
+			help="Number of cores all sessions may use together. Default = all cores.",
+			default=multiprocessing.cpu_count())
+		parser.add_argument('-t', '--threads', type=int,
+			help="Number of workers (cores) of every session (RunBundler -t). Default = 4.",
+			default=4)
+		parser.add_argument('-M', '--memory', type=float,
+			help="Memory in MB all sessions may use together. Default = 80%% of the physical memory.",
+			default=None)
+		parser.add_argument('-sm', '--session_memory', type=float,
+			help="Memory in MB of a session that has no metrics of an earlier run. Default = 2048.",
+			default=2048)
+		parser.add_argument('-a', '--bundler_args', type=str,
+			help="Options handed to RunBundler.py, eg. -a '-m native -st 1'.",
+			default="")
+		parser.add_argument('-pmvs', '--pmvs', type=bool,
+			help="Set to True to run RunPMVS.py after RunBundler.py in every session.",
+			default=False)
+		parser.add_argument('-pa', '--pmvs_args', type=str,
+			help="Options handed to RunPMVS.py.",
+			default="")
+		parser.add_argument('-o', '--report_dir', type=str,
+			help="Directory of the logs & the report of the batch. Default = 'batch'.",
+			default="batch")
+
+		try:
+			args = parser.parse_args(namespace=self)
+		except:
+			parser.print_help()
+			sys.exit()
+
+	def fits(self, session, running):
+		cores = sum(s.threads for s in running) + session.threads
+		memory = sum(s.memory_mb for s in running) + session.memory_mb
+		return cores <= self.cores and memory <= self.memory
+
+	def run(self):
+		# shortest job first, among the sessions that fit in the budget
+		self.started = time.time()
+		waiting = sorted(self.sessions, key=lambda s: s.estimate_seconds)
+		running = []
+		self.peak_running = 0
+		number = 0
+		while waiting or running:
+			for session in list(waiting):
+				# a session larger than the budget runs alone
+				if self.fits(session, running) or not running:
+					waiting.remove(session)
+					number += 1
+					session.number = number
+					session.started = time.time()
+					session.start_step(self.report_dir)
+					running.append(session)
+					print "Started %s (%s photos, estimated %.0f s, %.0f MB from %s), %s running" %(session.name,
+						session.photos, session.estimate_seconds, session.memory_mb, session.estimated_from, len(running))
+			self.peak_running = max(self.peak_running, len(running))
+
+			session, rusage = wait_any(running)
+			if session.end_step(rusage):
+				session.start_step(self.report_dir)
+				continue
+			running.remove(session)
+			session.finished = time.time()
+			print "Finished %s in %.0f s, exit code %s (see %s)" %(session.name, session.finished-session.started,
+				session.process.returncode, session.log_fns[-1])
+		self.finished = time.time()
+
+	def report(self):
+		"""Write batch.json & batch.csv to the report directory, print the throughput"""
+		sessions = [s.summary() for s in sorted(self.sessions, key=lambda s: s.started)]
+		wall = self.finished - self.started
+		done = [s for s in sessions if s['returncode'] == 0]
+		cpu = sum(s['cpu_seconds'] for s in sessions)
+		totals = dict(sessions=len(sessions), succeeded=len(done), failed=len(sessions)-len(done),
+			wall_seconds=wall, cpu_seconds=cpu, core_utilization=cpu / (wall * self.cores) if wall else 0,
+			cores=self.cores, memory_mb=self.memory, peak_sessions=self.peak_running,
+			sessions_per_hour=3600.0 * len(done) / wall if wall else 0,
+			photos_per_hour=3600.0 * sum(s['photos'] for s in done) / wall if wall else 0)
+		stages = {}
+		for s in sessions:
+			for name, seconds in s.get('stages', {}).items():
+				stages[name] = stages.get(name, 0) + seconds
+		totals['stage_seconds'] = stages
+
+		f = open(os.path.join(self.report_dir, "batch.json"), "w")
+		json.dump(dict(totals=totals, sessions=sessions), f, indent=1, sort_keys=True)
+		f.close()
+		columns = ["session", "photos", "returncode", "wall_seconds", "cpu_seconds", "peak_rss_mb",
+			"estimate_seconds", "estimated_from", "memory_mb", "data_in"]
+		f = open(os.path.join(self.report_dir, "batch.csv"), "wb")
+		writer = csv.writer(f)
+		writer.writerow(columns)
+		for s in sessions:
+			writer.writerow([s[c] for c in columns])
+		f.close()
+
+		print "\nBatch Report (see %s):\n\
+		\tSessions: %s succeeded, %s failed, at most %s at once\n\
+		\tWall Time: %.0f s, CPU Time: %.0f s, %.0f%% of %s cores\n\
+		\tThroughput: %.1f sessions/hour, %.0f photos/hour\n%s" %(self.report_dir, totals['succeeded'], totals['failed'],
+			totals['peak_sessions'], wall, cpu, 100*totals['core_utilization'], self.cores,
+			totals['sessions_per_hour'], totals['photos_per_hour'],
+			"".join("\t\t\t%s: %.0f s\n" %(name, seconds) for name, seconds in sorted(stages.items(), key=lambda i: -i[1])))
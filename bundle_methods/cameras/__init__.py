@@ -0,0 +1 @@
+__all__ = ["sensors"]
\ No newline at end of file
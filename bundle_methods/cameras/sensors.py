@@ -0,0 +1,77 @@
+"""
+Camera sensor lookup
+
+The cameras table of cameras.sqlite is small and read-only at runtime,
+so it is loaded once into a dict keyed on normalized (make, model).
+Normalization is tolerant to case, whitespace, corporate suffixes of the
+make ("NIKON CORPORATION" == "Nikon") and the vendor prefix many cameras
+repeat in the model ("Canon PowerShot S40" == "PowerShot S40").
+"""
+import sqlite3
+from threading import Lock
+
+import numpy as np
+
+# makes written differently by the cameras than in the database
+MAKE_ALIASES = {"eastman": "kodak", "hewlett-packard": "hp"}
+
+def normalize(make, model):
+	# exif strings are often padded with NUL characters
+	make = " ".join(make.replace("\x00", " ").lower().split())
+	model = " ".join(model.replace("\x00", " ").lower().split())
+	# first word of the make: "pentax corporation" -> "pentax"
+	make = make.split(" ")[0] if make else make
+	make = MAKE_ALIASES.get(make, make)
+	# drop vendor prefix from the model: "canon powershot s40" -> "powershot s40"
+	for prefix in (make+" ", make+"-"):
+		if model.startswith(prefix):
+			model = model[len(prefix):]
+	return make, model
+
+class SensorIndex(object):
+	"""In-memory index: normalized (make, model) -> ccd width in mm"""
+	def __init__(self, camera_db):
+		conn = sqlite3.connect(camera_db)
+		rows = conn.execute("select make, model, ccd_width from cameras").fetchall()
+		conn.close()
+		self.ccd_widths = {}
+		for make, model, ccd_width in rows:
+			self.ccd_widths[normalize(make, model)] = float(ccd_width)
+
+	def __len__(self):
+		return len(self.ccd_widths)
+
+	def ccd_width(self, make, model):
+		"""ccd width in mm or None if the camera is unknown"""
+		return self.ccd_widths.get(normalize(make, model))
+
+	def lookup(self, makes, models):
+		"""Batch lookup, OUTPUT: array of ccd widths (nan for unknown cameras)"""
+		return np.array([self.ccd_widths.get(normalize(make, model), np.nan)
+						for make, model in zip(makes, models)], dtype=np.float64)
+
+	def focal_pixels(self, makes, models, focal_lengths, widths, heights):
+		"""Focal lengths in pixels for a list of photos in one pass
+			focal_pixels = max(width, height) * focal length / ccd width
+			OUTPUT: array, nan where the camera is unknown or values are not > 0
+		"""
+		ccd_widths = self.lookup(makes, models)
+		focal_lengths = np.asarray(focal_lengths, dtype=np.float64)
+		widths = np.asarray(widths, dtype=np.float64)
+		heights = np.asarray(heights, dtype=np.float64)
+
+		with np.errstate(invalid='ignore'):
+			focal_pixels = np.maximum(widths, heights) * (focal_lengths / ccd_widths)
+			valid = (focal_lengths > 0) & (widths > 0) & (heights > 0)
+		focal_pixels[~valid] = np.nan
+		return focal_pixels
+
+# one index per process and camera database, shared by all threads
+_indexes = {}
+_indexes_lock = Lock()
+
+def get_index(camera_db):
+	with _indexes_lock:
+		if camera_db not in _indexes:
+			_indexes[camera_db] = SensorIndex(camera_db)
+		return _indexes[camera_db]
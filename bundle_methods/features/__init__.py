@@ -1 +1 @@
-__all__ = ["siftvlfeat", "siftvlfeat2", "siftlowe", "surfcv"]
\ No newline at end of file
+__all__ = ["siftvlfeat", "siftvlfeat2", "siftlowe", "surfcv", "klt"]
\ No newline at end of file
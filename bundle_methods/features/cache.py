@@ -0,0 +1,93 @@
+"""
+Persistent on-disk cache for extracted features
+
+Entries are keyed on the content hash of the source image, the resize
+target (max_size) and the feature extractor (class name and parameters),
+so it is shared by all FeatureExtractor subclasses.  A hit hands the cached
+features to the feature container instead of running the extractor again.
+An entry is binary, in the layout of the container: the number of
+keypoints (uint32), the keypoints (float32, 4 per keypoint) and the
+descriptors (uint8, 128 per keypoint).
+
+The cache has a size cap, least recently used entries are evicted first
+(the modification time of an entry is updated on every hit).
+"""
+import os, hashlib, stat
+
+import numpy as np
+
+from bundle_methods.storage import write_file
+
+class FeatureCache(object):
+	def __init__(self, cache_dir, max_size_mb=2048):
+		self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+		self.max_bytes = int(max_size_mb*1024*1024)
+		if not os.path.isdir(self.cache_dir):
+			os.makedirs(self.cache_dir)
+
+	def key(self, image_hash, max_size, feature_engine):
+		return hashlib.sha1("%s %s %s" %(image_hash, max_size, feature_engine.cache_key())).hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.cache_dir, key[:2], "%s.features" %key)
+
+	def fetch(self, key):
+		"""(keypoints, descriptors) of the entry, None if not cached"""
+		src = self.path(key)
+		try:
+			os.utime(src, None) # mark as recently used
+			f = open(src, "rb")
+			data = f.read()
+			f.close()
+		except (OSError, IOError):
+			return None # not cached (or evicted meanwhile)
+		n = int(np.frombuffer(data[:4], dtype=np.uint32)[0])
+		if len(data) != 4 + n*(16+128):
+			return None # damaged entry
+		keypoints = np.frombuffer(data[4:4+16*n], dtype=np.float32).reshape(n, 4)
+		descriptors = np.frombuffer(data[4+16*n:], dtype=np.uint8).reshape(n, 128)
+		return keypoints, descriptors
+
+	def store(self, key, keypoints, descriptors):
+		"""Write the features of an entry
+			The entry is replaced atomically (see storage.write_file), so
+			workers storing the same entry never see partial files.
+		"""
+		dst = self.path(key)
+		if not os.path.isdir(os.path.dirname(dst)):
+			try:
+				os.makedirs(os.path.dirname(dst))
+			except OSError:
+				pass # created by another worker
+		write_file(dst, np.uint32(len(keypoints)).tostring() +
+			np.ascontiguousarray(keypoints, dtype=np.float32).tostring() +
+			np.ascontiguousarray(descriptors, dtype=np.uint8).tostring())
+
+	def evict(self):
+		"""Remove least recently used entries until the cache fits max_bytes
+			OUTPUT: number of removed entries
+		"""
+		entries = []
+		total = 0
+		for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+			for fn in filenames:
+				p = os.path.join(dirpath, fn)
+				try:
+					st = os.stat(p)
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, p))
+				total += st.st_size
+
+		removed = 0
+		for mtime, size, p in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.chmod(p, stat.S_IWUSR|stat.S_IRUSR|stat.S_IRGRP|stat.S_IROTH)
+				os.remove(p)
+			except OSError:
+				continue
+			total -= size
+			removed += 1
+		return removed
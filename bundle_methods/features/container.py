@@ -0,0 +1,184 @@
+"""
+Binary feature container of an SfM directory
+
+All images of the SfM directory share one container, stored column by
+column in flat files:
+	<prefix>.keypoints     float32 (total keypoints, 4), y, x, scale, orientation
+	<prefix>.descriptors   uint8 (total keypoints, 128)
+	<prefix>.index         one line per image: "<name> <first row> <rows> <source mtime>"
+The rows of an image are contiguous.  Feature extraction workers append
+the rows of every image under a lock shared by the pool and hand the
+position back, the index is written once by the caller (update_index).
+Readers map the columns read-only, so the pages are shared by all
+matching workers through the page cache.
+
+Images are named like the key files of the features list without the
+extension ("00000001.key" -> "00000001").  The source mtime is that of
+the Lowe key file an image was decoded from (see matching/pack.py), 0
+for images written by a feature extractor.  Rows of an image extracted
+again are not reclaimed, the index points at the new ones.
+
+Bundler and KeyMatchFull read Lowe key files: export_lowe writes them
+on demand from the container.  The content hash of the features of every
+exported key file is kept in <prefix>.exported, a key file is written
+again only when the features of its image changed.
+"""
+import os, hashlib
+import multiprocessing
+
+import numpy as np
+
+from lowe import write_lowe, key_file
+from bundle_methods.storage import write_file
+
+CONTAINER_PREFIX = "features"
+DESCRIPTOR_LENGTH = 128
+
+def container_files(prefix):
+	return ["%s.%s" %(prefix, ext) for ext in ("keypoints", "descriptors", "index")]
+
+def features_sha1(keypoints, descriptors):
+	"""Content hash of the features of an image"""
+	sha1 = hashlib.sha1()
+	sha1.update(np.ascontiguousarray(keypoints, dtype=np.float32))
+	sha1.update(np.ascontiguousarray(descriptors, dtype=np.uint8))
+	return sha1.hexdigest()
+
+def image_name(fn):
+	"""Name of an image in the container from a key file path"""
+	name = os.path.basename(fn)
+	if name.endswith(".gz"):
+		name = name[:-3]
+	return os.path.splitext(name)[0]
+
+def read_index(prefix):
+	"""OUTPUT: dict name -> (first row, rows, source mtime)"""
+	index = {}
+	if not os.path.exists("%s.index" % prefix):
+		return index
+	f = open("%s.index" % prefix, "r")
+	for l in f:
+		v = l.split()
+		if len(v) == 4:
+			index[v[0]] = (int(v[1]), int(v[2]), float(v[3]))
+	f.close()
+	return index
+
+def update_index(prefix, entries):
+	"""Add (name, first row, rows, source mtime) entries to the index
+		The index is replaced atomically (see storage.write_file),
+		readers never see a partial index.
+	"""
+	index = read_index(prefix)
+	for name, row, count, mtime in entries:
+		index[name] = (row, count, mtime)
+	write_file("%s.index" % prefix, "".join("%s %d %d %.6f\n" % ((name,) + index[name]) for name in sorted(index)))
+
+def append_features(prefix, keypoints, descriptors, lock):
+	"""Append the features of one image to the container
+		keypoints: array (n, 4) with y, x, scale, orientation
+		descriptors: array (n, 128) of integers 0..255
+		lock: lock shared by all writers of the container
+		OUTPUT: (first row, rows)
+	"""
+	keypoints = np.ascontiguousarray(keypoints, dtype=np.float32).reshape(-1, 4)
+	descriptors = np.ascontiguousarray(descriptors, dtype=np.uint8).reshape(-1, DESCRIPTOR_LENGTH)
+	lock.acquire()
+	try:
+		d = open("%s.descriptors" % prefix, "ab")
+		k = open("%s.keypoints" % prefix, "ab")
+		d.seek(0, os.SEEK_END)
+		row = d.tell() // DESCRIPTOR_LENGTH
+		d.write(descriptors.tostring())
+		k.write(keypoints.tostring())
+		d.close()
+		k.close()
+	finally:
+		lock.release()
+	return row, len(keypoints)
+
+class FeatureContainer(object):
+	def __init__(self, prefix):
+		self.prefix = os.path.abspath(prefix)
+		self.index = read_index(self.prefix)
+		total = os.path.getsize("%s.descriptors" % self.prefix) // DESCRIPTOR_LENGTH if self.index else 0
+		# np.memmap can't map empty files
+		self.descriptors = np.zeros((0, DESCRIPTOR_LENGTH), np.uint8)
+		self.keypoints = np.zeros((0, 4), np.float32)
+		if total > 0:
+			self.descriptors = np.memmap("%s.descriptors" % self.prefix, dtype=np.uint8, mode="r",
+										 shape=(total, DESCRIPTOR_LENGTH))
+			self.keypoints = np.memmap("%s.keypoints" % self.prefix, dtype=np.float32, mode="r",
+									   shape=(total, 4))
+
+	def __contains__(self, name):
+		return name in self.index
+
+	def rows(self, name):
+		row, count, mtime = self.index[name]
+		return row, row+count
+
+	def image_keypoints(self, name):
+		start, stop = self.rows(name)
+		return self.keypoints[start:stop]
+
+	def image_descriptors(self, name):
+		start, stop = self.rows(name)
+		return self.descriptors[start:stop]
+
+def export_image(job):
+	prefix, name, lowe_gz_fn = job
+	container = FeatureContainer(prefix)
+	write_lowe(lowe_gz_fn, container.image_keypoints(name), container.image_descriptors(name))
+
+def read_exported(prefix):
+	"""OUTPUT: dict name -> (features hash, mtime of the key file) of the exported key files"""
+	exported = {}
+	if not os.path.exists("%s.exported" % prefix):
+		return exported
+	f = open("%s.exported" % prefix, "r")
+	for l in f:
+		v = l.split()
+		if len(v) == 3:
+			exported[v[0]] = (v[1], float(v[2]))
+	f.close()
+	return exported
+
+def export_lowe(prefix, features_list_fn, num_workers=8):
+	"""Write the Lowe key files ("<name>.key.gz" next to the list) of the features list
+		Key files exported from the same features (see <prefix>.exported),
+		and not changed since, are up to date and not written again.
+		OUTPUT: number of key files written
+	"""
+	prefix = os.path.abspath(prefix)
+	list_dir = os.path.dirname(os.path.abspath(features_list_fn))
+	f = open(features_list_fn, "r")
+	key_files = [os.path.join(list_dir, l.strip()) for l in f if l.strip()]
+	f.close()
+	container = FeatureContainer(prefix)
+	exported = read_exported(prefix)
+	jobs = []
+	hashes = {}
+	for fn in key_files:
+		name = image_name(fn)
+		if name not in container or container.index[name][2] > 0:
+			continue # not in the container, or decoded from this key file
+		gz_fn = fn if fn.endswith(".gz") else fn + ".gz"
+		hashes[name] = features_sha1(container.image_keypoints(name), container.image_descriptors(name))
+		if name in exported and exported[name][0] == hashes[name] and \
+				os.path.exists(gz_fn) and os.path.getmtime(gz_fn) == exported[name][1]:
+			continue
+		jobs.append((prefix, name, gz_fn))
+	if not jobs:
+		return 0
+	pool = multiprocessing.Pool(num_workers)
+	try:
+		pool.map(export_image, jobs, chunksize=1)
+	finally:
+		pool.close()
+		pool.join()
+
+	for job_prefix, name, gz_fn in jobs:
+		exported[name] = (hashes[name], os.path.getmtime(gz_fn))
+	write_file("%s.exported" % prefix, "".join("%s %s %r\n" % ((name,) + exported[name]) for name in sorted(exported)))
+	return len(jobs)
@@ -1,7 +1,21 @@
+from bundle_methods.storage import cache_key
 
 class FeatureExtractor():
+    # names of attributes that change the extracted features
+    # (used with the class name to key the feature cache)
+    params = ()
+
     def __init__(self, distrDir):
         pass
 
-    def extract(self, photo, photoInfo):
-        pass
\ No newline at end of file
+    def extract(self, photo, photoInfo, pgm=None):
+        """Extract features of photo (absolute path of the photo copy)
+            pgm: grayscale image as PGM bytes, if None the extractor
+            reads the image from "<photo>.pgm"
+            OUTPUT: (keypoints, descriptors) in the layout of lowe.read_lowe,
+                the caller appends them to the feature container (container.py)
+        """
+        pass
+
+    def cache_key(self):
+        return cache_key(self)
\ No newline at end of file
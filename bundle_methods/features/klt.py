@@ -0,0 +1,34 @@
+import logging
+
+import cv2
+import numpy as np
+
+from extractor import FeatureExtractor
+
+className = "KltCorners"
+class KltCorners(FeatureExtractor):
+    """Shi-Tomasi corners for KLT tracking (see matching/klt.py)
+        The features are stubs: corner positions with zero descriptors,
+        correspondences come from tracking the corners through the video.
+    """
+    fileExtension = "key"
+    params = ("max_corners", "quality", "min_distance")
+
+    def __init__(self, distrDir):
+        self.max_corners = 4000
+        self.quality = 0.005
+        self.min_distance = 5
+
+    def extract(self, photo, photoInfo, pgm=None):
+        logging.info("\tDetecting corners for KLT tracking...")
+        if pgm is None:
+            gray = cv2.imread("%s.pgm" % photo, cv2.IMREAD_GRAYSCALE)
+        else:
+            gray = cv2.imdecode(np.frombuffer(pgm, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+
+        corners = cv2.goodFeaturesToTrack(gray, self.max_corners, self.quality, self.min_distance)
+        corners = np.zeros((0, 2)) if corners is None else corners.reshape(-1, 2)
+        # Lowe's format: y, x, scale, orientation
+        keypoints = np.column_stack((corners[:,1], corners[:,0], np.ones(len(corners)), np.zeros(len(corners))))
+        logging.info("\tFound %s corners" % len(corners))
+        return keypoints, np.zeros((len(keypoints), 128), dtype=np.uint8)
@@ -0,0 +1,175 @@
+"""
+Helpers for David Lowe's .key format (used by Bundler and KeyMatchFull)
+
+Lowe's format: header "<number of keypoints> 128", then for every keypoint
+one line "y x scale orientation" followed by the 128 descriptor values
+wrapped over 7 lines (6*20 + 8 values).
+"""
+import os, gzip
+
+import numpy as np
+
+# VLFeat writes x before y, Lowe's format expects y before x
+VLFEAT_TO_LOWE = np.r_[1, 0, 2:132]
+
+# separator written after each of the 132 values of a keypoint
+LOWE_SEPARATORS = np.array([ord(" ")]*132, dtype=np.uint8)
+LOWE_SEPARATORS[[3, 23, 43, 63, 83, 103, 123, 131]] = ord("\n")
+
+# text of the position of a keypoint, as VLFeat writes it ("%g", 6 significant
+# digits): every value of such a text reads back as float32 and prints the same
+LOWE_KEYPOINT = "%g %g %g %g\n"
+# float32 values with more digits (eg. from SurfCV) are written exactly with 9
+EXACT_FLOAT32 = "%.9g"
+
+# text of the descriptor values 0..255, value v is DECIMALS[DECIMAL_STARTS[v]:][:DECIMAL_LENGTHS[v]]
+DECIMALS = np.frombuffer("".join("%d" % v for v in xrange(256)), dtype=np.uint8)
+DECIMAL_LENGTHS = np.array([len("%d" % v) for v in xrange(256)])
+DECIMAL_STARTS = np.r_[0, np.cumsum(DECIMAL_LENGTHS)[:-1]]
+
+# characters str.split() treats as whitespace
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[[ord(c) for c in " \t\n\r\x0b\x0c"]] = True
+
+def lowe_block(data, starts, lengths):
+	"""Text of keypoints in Lowe's format from the text of their values
+		data: uint8 array holding the text of the values
+		starts, lengths: the 132 values of every keypoint in data, keypoint after keypoint
+		All values are copied with one gather and followed by the
+		separators of Lowe's format.
+	"""
+	num_features = len(starts) // 132
+	out_lengths = lengths + 1 # value + separator
+	out_ends = np.cumsum(out_lengths)
+
+	# index of the source byte for every output byte
+	src = np.repeat(starts - (out_ends - out_lengths), out_lengths)
+	src += np.arange(len(src))
+	np.minimum(src, len(data) - 1, out=src)
+	out = data[src]
+	out[out_ends - 1] = np.tile(LOWE_SEPARATORS, num_features)
+	return out.tostring()
+
+def count_lines(fn, block_size=1<<20):
+	"""Count lines of a text file without loading it into memory"""
+	f = open(fn, "rb")
+	count = 0
+	last = "\n"
+	block = f.read(block_size)
+	while block:
+		count += block.count("\n")
+		last = block[-1]
+		block = f.read(block_size)
+	f.close()
+	if last != "\n":
+		count += 1
+	return count
+
+def read_line_blocks(f, block_size=1<<20):
+	"""Yield blocks of about block_size bytes that end on a line break"""
+	rest = ""
+	while True:
+		block = f.read(block_size)
+		if not block:
+			break
+		block = rest + block
+		cut = block.rfind("\n") + 1
+		if cut == 0:
+			rest = block
+			continue
+		rest = block[cut:]
+		yield block[:cut]
+	if rest:
+		yield rest
+
+def read_vlfeat(vlfeat_fn, block_size=1<<20):
+	"""Read a VLFeat text key file (one keypoint per line: x y scale orientation descriptor)
+		The file is streamed in blocks of about block_size bytes into
+		arrays allocated for all keypoints, the text is never held whole.
+		OUTPUT: (keypoints, descriptors) in the layout of read_lowe
+	"""
+	num_features = count_lines(vlfeat_fn)
+	keypoints = np.zeros((num_features, 4), dtype=np.float32)
+	descriptors = np.zeros((num_features, 128), dtype=np.uint8)
+	f = open(vlfeat_fn, "rb")
+	n = 0
+	for block in read_line_blocks(f, block_size):
+		values = np.fromstring(block, dtype=np.float32, sep=" ").reshape(-1, 132)[:,VLFEAT_TO_LOWE]
+		keypoints[n:n+len(values)] = values[:,:4]
+		descriptors[n:n+len(values)] = values[:,4:]
+		n += len(values)
+	f.close()
+	return keypoints[:n], descriptors[:n]
+
+def key_file(fn):
+	"""Path of a key file listed as "<name>.key", which may be gzipped"""
+	if not os.path.exists(fn) and os.path.exists(fn+".gz"):
+		return fn+".gz"
+	return fn
+
+def read_lowe(fn):
+	"""Read a Lowe .key file (or .key.gz)
+		OUTPUT: (keypoints, descriptors)
+			keypoints: float32 array (n, 4) with y, x, scale, orientation
+			descriptors: uint8 array (n, 128)
+	"""
+	fn = key_file(fn)
+	if fn.endswith(".gz"):
+		f = gzip.open(fn, "rb")
+	else:
+		f = open(fn, "rb")
+	text = f.read()
+	f.close()
+	return parse_lowe(text)
+
+def parse_lowe(text):
+	"""Keypoints & descriptors of the text of a Lowe .key file, see read_lowe"""
+	values = np.fromstring(text, dtype=np.float32, sep=" ")
+	if len(values) < 2:
+		return np.zeros((0, 4), np.float32), np.zeros((0, 128), np.uint8)
+	num_features, length = int(values[0]), int(values[1])
+	values = values[2:2+num_features*(4+length)].reshape(num_features, 4+length)
+	return values[:,:4].copy(), values[:,4:].astype(np.uint8)
+
+def keypoint_text(keypoints):
+	"""Text of keypoints (float32 array (n, 4)), one line per keypoint
+		Values read from VLFeat's text print as VLFeat wrote them, other
+		values are written exactly (EXACT_FLOAT32).
+	"""
+	values = keypoints.ravel()
+	text = (LOWE_KEYPOINT * len(keypoints)) % tuple(values.tolist())
+	if (np.fromstring(text, dtype=np.float32, sep=" ") == values).all():
+		return text
+	lines = []
+	for keypoint in keypoints.tolist():
+		lines.append(" ".join([("%g" if np.float32("%g" % v) == v else EXACT_FLOAT32) % v for v in keypoint]) + "\n")
+	return "".join(lines)
+
+def write_lowe(lowe_gz_fn, keypoints, descriptors=None, block_size=4096):
+	"""Write a gzipped Lowe .key file
+		keypoints: array (n, 4) with y, x, scale, orientation
+		descriptors: array (n, 128) of integers 0..255, None for zero descriptors
+			(key files of detectors without descriptors, eg. KLT corners)
+		The text of block_size keypoints at a time is built with array
+		operations (see lowe_block): descriptor values are looked up in
+		DECIMALS, the keypoint positions are formatted with one format call.
+		Features read from VLFeat's text give the file converting the text
+		itself would: the same text, compressed at gzip's default level 9.
+	"""
+	keypoints = np.asarray(keypoints, dtype=np.float32).reshape(-1, 4)
+	if descriptors is None:
+		descriptors = np.zeros((len(keypoints), 128), dtype=np.uint8)
+	descriptors = np.asarray(descriptors).reshape(-1, 128).astype(np.uint8)
+	lowe_file = gzip.open(lowe_gz_fn, "wb")
+	lowe_file.write("%s 128\n" % len(keypoints))
+	for start in xrange(0, len(keypoints), block_size):
+		block = keypoints[start:start+block_size]
+		text = np.frombuffer(keypoint_text(block), dtype=np.uint8)
+		edges = np.diff(np.r_[0, ~WHITESPACE[text], 0].astype(np.int8))
+		starts = np.flatnonzero(edges == 1)
+		lengths = np.flatnonzero(edges == -1) - starts
+		values = descriptors[start:start+block_size]
+		starts = np.hstack((starts.reshape(-1, 4), len(text) + DECIMAL_STARTS[values])).ravel()
+		lengths = np.hstack((lengths.reshape(-1, 4), DECIMAL_LENGTHS[values])).ravel()
+		lowe_file.write(lowe_block(np.concatenate((text, DECIMALS)), starts, lengths))
+	lowe_file.close()
@@ -1,7 +1,38 @@
-import sys, os, logging
+import sys, os, logging, tempfile
+from contextlib import contextmanager
 
 from extractor import FeatureExtractor
 
+# RAM backed directory for files handed to the SIFT binaries
+if os.path.isdir("/dev/shm"):
+    SCRATCH_DIR = "/dev/shm"
+else:
+    SCRATCH_DIR = tempfile.gettempdir()
+
+@contextmanager
+def scratch_file(suffix, data=None):
+    """Temporary file in SCRATCH_DIR, removed on exit"""
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=SCRATCH_DIR)
+    try:
+        if data is not None:
+            os.write(fd, data)
+        os.close(fd)
+        yield path
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+@contextmanager
+def pgm_input(photo, pgm=None):
+    """Path of the pgm image for a SIFT binary
+        "<photo>.pgm" if pgm is None, otherwise a scratch file with the pgm data
+    """
+    if pgm is None:
+        yield "%s.pgm" % photo
+    else:
+        with scratch_file(".pgm", pgm) as path:
+            yield path
+
 class Sift(FeatureExtractor):
     
     fileExtension = "key"
@@ -17,5 +48,5 @@ class Sift(FeatureExtractor):
             self.executable = os.path.join(distrDir, self.linuxExecutable)
         logging.info("Sift executable path: %s" % self.executable)
 
-    def extract(self, photo, photoInfo):
+    def extract(self, photo, photoInfo, pgm=None):
         pass
\ No newline at end of file
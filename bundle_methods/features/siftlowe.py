@@ -1,6 +1,7 @@
-import os, subprocess, gzip
+import subprocess
 
 from sift import Sift
+from lowe import parse_lowe
 
 className = "LoweSift"
 class LoweSift(Sift):
@@ -11,16 +12,12 @@ class LoweSift(Sift):
     def __init__(self, distrDir):
         Sift.__init__(self, distrDir)
 
-    def extract(self, photo, photoInfo):
-        photoFile = open("%s.jpg.pgm" % photo, "rb")
-        siftTextFile = open("%s.key" % photo, "w")
-        subprocess.call(self.executable, **dict(stdin=photoFile, stdout=siftTextFile))
-        photoFile.close()
-        siftTextFile.close()
-        # gzip SIFT file and remove it
-        siftTextFile = open("%s.key" % photo, "r")
-        siftGzipFile = gzip.open("%s.key.gz" % photo, "wb")
-        siftGzipFile.writelines(siftTextFile)
-        siftGzipFile.close()
-        siftTextFile.close()
-        os.remove("%s.key" % photo)
\ No newline at end of file
+    def extract(self, photo, photoInfo, pgm=None):
+        if pgm is None:
+            photoFile = open("%s.pgm" % photo, "rb")
+            pgm = photoFile.read()
+            photoFile.close()
+        # the binary reads the pgm from stdin and writes keys to stdout
+        sift = subprocess.Popen(self.executable, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        siftText = sift.communicate(pgm)[0]
+        return parse_lowe(siftText)
\ No newline at end of file
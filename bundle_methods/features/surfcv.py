@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 # encoding: utf-8
-import os, subprocess, gzip, logging
+import logging
 
 import cv2
 import numpy as np
@@ -10,13 +10,15 @@ from sift import Sift
 className = "SurfCV"
 class SurfCV(Sift):
 	
+	params = ("thresh", "octaves", "layers")
+
 	def __init__(self, distrDir):
 		Sift.__init__(self, distrDir)
 		self.thresh=500
 		self.octaves=4
 		self.layers=2
 		
-	def extract(self, photo, photoInfo):
+	def extract(self, photo, photoInfo, pgm=None):
 		logging.info("\tExtracting features with the SURF method from OpenCV library...")
 	
 		# make an opencv image from photo dir
@@ -34,18 +36,11 @@ class SurfCV(Sift):
 		kp = detector.detect(img)
 		kp, desc = extractor.compute(img, kp)
 		
-		# write the .key file in David Lowe's format
-		loweGzipFile = gzip.open("%s.key.gz" % photo, "wb")
-		loweGzipFile.write("%s %s\n" %(len(kp), len(desc[0])) ) # header for Lowe format
-		desc = np.int32(desc) # Bundler's Keypoint matcher doesn't deal well with floats
-        
-		for k, d in zip(kp, desc):
-			loweGzipFile.write("%s %s %s %s\n %s\n %s\n %s\n %s\n %s\n %s\n %s\n" \
-								%(photoInfo['width']-k.pt[0], k.pt[1], k.size, np.radians(k.angle), 
-								" ".join(map(str, d[0:20])), " ".join(map(str, d[20:40])), " ".join(map(str, d[40:60])), 
-								" ".join(map(str, d[60:80])), " ".join(map(str, d[80:100])), " ".join(map(str, d[100:120])),
-								" ".join(map(str, d[120:])) ))
-								
-		loweGzipFile.close()
+		# Lowe's layout (y, x, scale, orientation), as arrays for the feature container
+		keypoints = np.array([(photoInfo['width']-k.pt[0], k.pt[1], k.size, np.radians(k.angle)) for k in kp],
+							 dtype=np.float32).reshape(-1, 4)
+		# Bundler's Keypoint matcher doesn't deal well with floats
+		descriptors = np.clip(np.int32(desc if desc is not None else np.zeros((0, 128))), 0, 255).astype(np.uint8).reshape(-1, 128)
 
 		logging.info("\tFound %s features" % len(kp))
+		return keypoints, descriptors
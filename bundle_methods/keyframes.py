@@ -0,0 +1,204 @@
+"""
+Keyframe selection from the world camera video (world.avi)
+
+The video is streamed frame by frame in parallel segments.  Every frame
+gets three scores, computed on a small grayscale thumbnail:
+	- sharpness: variance of the Laplacian (low for motion blur)
+	- motion: median displacement of corners tracked from the previous frame
+	  (as a fraction of the frame width)
+	- overlap: fraction of the corners of the previous frame tracked into the frame
+Only the scores are kept, so memory does not depend on the video length.
+
+Keyframes are picked along the cumulative overlap loss of the video
+(-log of the chained frame to frame overlap, see overlap_loss): either a target number of
+keyframes spread evenly along it, or a new keyframe each time the overlap
+with the previous keyframe drops to a target value.  Inside each interval
+the frame closest to the middle among the sharpest frames is used.  Remaining frames that are not blurred are
+written as otherframes (to be added later with AddToBundle.py).
+"""
+import sys, os, argparse, logging
+import multiprocessing
+
+import numpy as np
+import cv2
+
+# cv2.CAP_PROP_* (cv2.cv.CV_CAP_PROP_* in OpenCV 2.4)
+CAP_PROP_POS_FRAMES = 1
+CAP_PROP_FRAME_COUNT = 7
+
+THUMB_WIDTH = 320
+MAX_CORNERS = 200
+
+def thumbnail(frame):
+	gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+	scale = float(THUMB_WIDTH)/gray.shape[1]
+	return cv2.resize(gray, (THUMB_WIDTH, int(round(gray.shape[0]*scale))), interpolation=cv2.INTER_AREA)
+
+def frame_motion(prev, gray):
+	"""Track corners of prev into gray
+		OUTPUT: (median displacement / frame width, fraction of corners tracked)
+	"""
+	corners = cv2.goodFeaturesToTrack(prev, MAX_CORNERS, 0.01, 8)
+	if corners is None or len(corners) == 0:
+		return 0.0, 1.0 # nothing to track on a textureless frame
+	tracked, status, err = cv2.calcOpticalFlowPyrLK(prev, gray, corners, None)
+	h, w = gray.shape
+	ok = status.ravel() == 1
+	ok &= (tracked[:,0,0] >= 0) & (tracked[:,0,0] < w) & (tracked[:,0,1] >= 0) & (tracked[:,0,1] < h)
+	if not ok.any():
+		return 1.0, 0.0
+	shift = np.sqrt(((tracked[ok] - corners[ok])**2).sum(axis=-1))
+	return float(np.median(shift))/w, ok.sum()/float(len(ok))
+
+def score_segment(args):
+	"""Score frames [start, stop) of the video
+		OUTPUT: (start, array of (sharpness, motion, overlap) per frame)
+	"""
+	video_path, start, stop = args
+	cap = cv2.VideoCapture(video_path)
+	# start one frame early so the first frame of the segment has a predecessor
+	first = max(start-1, 0)
+	cap.set(CAP_PROP_POS_FRAMES, first)
+
+	scores = []
+	prev = None
+	for i in xrange(first, stop):
+		ok, frame = cap.read()
+		if not ok:
+			break
+		gray = thumbnail(frame)
+		if i >= start:
+			sharpness = cv2.Laplacian(gray, cv2.CV_64F).var()
+			if prev is None:
+				motion, overlap = 0.0, 1.0
+			else:
+				motion, overlap = frame_motion(prev, gray)
+			scores.append((sharpness, motion, overlap))
+		prev = gray
+	cap.release()
+	return start, np.array(scores, dtype=np.float64).reshape(-1, 3)
+
+def score_video(video_path, num_workers=8, segment_length=500):
+	"""Score all frames of the video, segments are scored in a process pool
+		OUTPUT: array (number of frames, 3) with sharpness, motion, overlap
+	"""
+	cap = cv2.VideoCapture(video_path)
+	if not cap.isOpened():
+		raise Exception, "Unable to open video '%s'" % video_path
+	num_frames = int(cap.get(CAP_PROP_FRAME_COUNT))
+	cap.release()
+
+	segments = [(video_path, s, min(s+segment_length, num_frames)) for s in xrange(0, num_frames, segment_length)]
+	pool = multiprocessing.Pool(num_workers)
+	try:
+		results = pool.map(score_segment, segments, chunksize=1)
+	finally:
+		pool.close()
+		pool.join()
+
+	# the frame count of the container may be too large: stop at the first short segment
+	scores = []
+	for (path, start, stop), (start, segment_scores) in zip(segments, results):
+		scores.append(segment_scores)
+		if len(segment_scores) < stop-start:
+			break
+	return np.concatenate(scores) if scores else np.zeros((0, 3))
+
+def overlap_loss(scores, min_feature_overlap=0.5):
+	"""Cumulative overlap loss: -log of the chained overlap from the first frame
+		Frame to frame overlap is the view overlap given by the motion.
+		The fraction of tracked corners also drops on blurred frames, so it
+		only counts when it is below min_feature_overlap (cuts, occlusions).
+	"""
+	overlap = 1.0 - scores[:,1]
+	feature_overlap = scores[:,2]
+	lost = feature_overlap < min_feature_overlap
+	overlap[lost] = np.minimum(overlap[lost], feature_overlap[lost])
+	overlap = np.clip(overlap, 1e-3, 1.0)
+	# small time term so static parts of the video still advance
+	return np.cumsum(-np.log(overlap)) + 1e-6*np.arange(len(scores))
+
+def select_keyframes(scores, num_keyframes=None, overlap=0.7, sharp_fraction=0.8):
+	"""Pick keyframes from the frame scores
+		num_keyframes: spread this number of keyframes evenly along the overlap loss
+		overlap: otherwise start a new interval each time the overlap with the
+			previous keyframe drops below this value
+		sharp_fraction: frames of an interval with a sharpness >= sharp_fraction 
+			* the best sharpness in the interval are candidates
+		OUTPUT: sorted array of keyframe numbers
+	"""
+	if len(scores) == 0:
+		return np.zeros(0, dtype=np.int64)
+	loss = overlap_loss(scores)
+	if num_keyframes:
+		edges = np.linspace(loss[0], loss[-1], num_keyframes+1)
+	else:
+		edges = np.arange(loss[0], loss[-1], -np.log(overlap))
+		edges = np.r_[edges, loss[-1]]
+	bins = np.clip(np.searchsorted(edges, loss, side='right')-1, 0, len(edges)-2)
+
+	keyframes = []
+	sharpness = scores[:,0]
+	for b in np.unique(bins):
+		frames = np.flatnonzero(bins == b)
+		frames = frames[sharpness[frames] >= sharp_fraction*sharpness[frames].max()]
+		middle = 0.5*(edges[b] + edges[b+1])
+		keyframes.append(frames[np.argmin(np.abs(loss[frames] - middle))])
+	return np.array(keyframes, dtype=np.int64)
+
+def select_otherframes(scores, keyframes, min_sharpness=0.3, step=1):
+	"""All frames that are not keyframes, every step-th one,
+		without frames blurrier than min_sharpness * median sharpness
+	"""
+	sharpness = scores[:,0]
+	frames = np.setdiff1d(np.arange(len(scores))[::step], keyframes)
+	return frames[sharpness[frames] >= min_sharpness*np.median(sharpness)]
+
+def save_frames(data_in, keyframes, otherframes):
+	np.save(os.path.join(data_in, "keyframes.npy"), keyframes)
+	np.save(os.path.join(data_in, "otherframes.npy"), otherframes)
+
+class KeyframeSelector(object):
+	"""Select keyframes from world.avi
+		INPUT: Directory with world.avi
+		OUTPUT: keyframes.npy & otherframes.npy in the same directory
+	"""
+	def __init__(self):
+		self.parse_command_line()
+		self.data_in = os.path.abspath(self.data_in)
+		self.video_path = os.path.join(self.data_in, "world.avi")
+		if not os.path.isfile(self.video_path):
+			raise Exception, "'%s' does not exist.  Please specify a directory with a world.avi file." %(self.video_path)
+
+	def parse_command_line(self):
+		parser = argparse.ArgumentParser(description="Select keyframes for Bundler from the world.avi video of a recording.")
+		parser.add_argument('-d', '--data_in', type=str,
+			help='A directory that contains world.avi (Required).',
+			required=True)
+		parser.add_argument('-n', '--num_keyframes', type=int,
+			help='Number of keyframes to select. Default = select by overlap (-o).',
+			default=None)
+		parser.add_argument('-o', '--overlap', type=float,
+			help='Select a new keyframe when the overlap with the previous one drops below this fraction. Default = 0.7.',
+			default=0.7)
+		parser.add_argument('-os', '--other_step', type=int,
+			help='Keep every n-th of the remaining frames as otherframes. Default = 1.',
+			default=1)
+		parser.add_argument('-t', '--num_threads', type=int,
+			help='Set number of processes scoring video segments.  Default = 8',
+			default=8)
+
+		try:
+			args = parser.parse_args(namespace=self)
+		except:
+			parser.print_help()
+			sys.exit()
+
+	def run(self):
+		logging.info("Scoring frames of %s..." % self.video_path)
+		scores = score_video(self.video_path, self.num_threads)
+		keyframes = select_keyframes(scores, self.num_keyframes, self.overlap)
+		otherframes = select_otherframes(scores, keyframes, step=self.other_step)
+		save_frames(self.data_in, keyframes, otherframes)
+		print "Selected %s keyframes and %s otherframes out of %s frames" %(len(keyframes), len(otherframes), len(scores))
+		return keyframes, otherframes
@@ -1 +1 @@
-__all__ = ["bundler", "manual"]
\ No newline at end of file
+__all__ = ["bundler", "manual", "native", "sequential", "klt"]
\ No newline at end of file
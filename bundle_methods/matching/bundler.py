@@ -1,12 +1,15 @@
 import sys,os,subprocess,logging
+import shutil,tempfile
+from multiprocessing.pool import ThreadPool
 
 from engine import MatchingEngine
+from bundle_methods.features.container import CONTAINER_PREFIX, export_lowe
 
 className = "BundlerMatching"
 class BundlerMatching(MatchingEngine):
-    featuresListFileName = "list_features.txt"
-    features_list_add_fn = "list_features.added.txt"
     executable = ''
+    # fewest images in a shard, smaller lists are matched by one KeyMatchFull
+    min_shard_size = 10
     
     def __init__(self, distrDir):
         if sys.platform == "win32":
@@ -17,4 +20,76 @@ class BundlerMatching(MatchingEngine):
 
     def match(self):
         logging.info("\nPerforming feature matching...")
-        subprocess.call([self.executable, self.featuresListFileName, self.outputFileName])
\ No newline at end of file
+        # KeyMatchFull reads Lowe key files
+        export_lowe(CONTAINER_PREFIX, self.featuresListFileName, self.num_workers)
+        f = open(self.featuresListFileName, "r")
+        key_files = [l.strip() for l in f if l.strip()]
+        f.close()
+        num_shards = self.num_shards(len(key_files))
+        if num_shards < 3:
+            if subprocess.call([self.executable, self.featuresListFileName, self.outputFileName]) != 0:
+                raise Exception, "KeyMatchFull failed on %s" % self.featuresListFileName
+        else:
+            self.match_sharded(key_files, num_shards)
+
+    def num_shards(self, num_images):
+        """Fewest shards giving a block pair to every worker"""
+        num_shards = 1
+        while num_shards*(num_shards-1)/2 < self.num_workers:
+            num_shards += 1
+        return min(num_shards, num_images // self.min_shard_size)
+
+    def match_sharded(self, key_files, num_shards):
+        """Run KeyMatchFull on block pairs of the features list in parallel
+            The list is cut into num_shards contiguous blocks, every pair of
+            blocks (a, b) is matched by one KeyMatchFull process on the list
+            a + b.  This covers the pairs between a and b, and the pairs
+            inside a and b: KeyMatchFull matches all pairs of its list, so
+            the pairs inside a block are matched by each of its block pairs
+            and kept from one block pair only (owner).
+            Shard indices are remapped to the features list when merging.
+        """
+        bounds = [len(key_files)*k/num_shards for k in xrange(num_shards+1)]
+        blocks = [range(bounds[k], bounds[k+1]) for k in xrange(num_shards)]
+        block_pairs = [(a, b) for a in xrange(num_shards) for b in xrange(a+1, num_shards)]
+        owner = dict((a, (a, a+1) if a+1 < num_shards else (a-1, a)) for a in xrange(num_shards))
+
+        shard_dir = tempfile.mkdtemp(prefix="shards_", dir=".")
+        def run(block_pair):
+            a, b = block_pair
+            list_fn = os.path.join(shard_dir, "list_%s_%s.txt" %(a, b))
+            out_fn = os.path.join(shard_dir, "matches_%s_%s.txt" %(a, b))
+            list_file = open(list_fn, "w")
+            for n in blocks[a] + blocks[b]:
+                list_file.write("%s\n" % key_files[n])
+            list_file.close()
+            if subprocess.call([self.executable, list_fn, out_fn]) != 0:
+                raise Exception, "KeyMatchFull failed on the shard %s" % list_fn
+            return out_fn
+
+        pool = ThreadPool(self.num_workers)
+        try:
+            out_fns = pool.map(run, block_pairs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        output = open(self.outputFileName, "w")
+        for (a, b), out_fn in zip(block_pairs, out_fns):
+            global_ids = blocks[a] + blocks[b]
+            shard_of = [a]*len(blocks[a]) + [b]*len(blocks[b])
+            shard_output = open(out_fn, "r")
+            while True:
+                header = shard_output.readline().split()
+                if len(header) < 2:
+                    break
+                j, i = int(header[0]), int(header[1])
+                num_matches = shard_output.readline()
+                lines = [shard_output.readline() for n in xrange(int(num_matches))]
+                if shard_of[j] == shard_of[i] and owner[shard_of[j]] != (a, b):
+                    continue # pair inside a block, kept from its owner
+                output.write("%d %d\n%s" %(global_ids[j], global_ids[i], num_matches))
+                output.writelines(lines)
+            shard_output.close()
+        output.close()
+        shutil.rmtree(shard_dir)
\ No newline at end of file
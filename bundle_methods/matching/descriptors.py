@@ -0,0 +1,114 @@
+"""
+Search index cache of matching workers, with a memory budget
+
+Descriptors are slices of the memory-mapped feature pack (see pack.py),
+shared by all workers and never decoded.  What a worker keeps is the
+search indexes it built (see native.FlannIndex), in an LRU cache: when
+the cache holds more than its budget, least recently used indexes are
+dropped and built again when needed.  Hits, misses (indexes built) and
+evictions are counted for the cache report of the matching engine.
+
+Pairs are scheduled in tiles so the working set fits the budget: the
+images are cut into row blocks (the second image of a pair, which is
+indexed) and column tiles (the first image, which is queried).  A job is
+one row block, its column tiles are matched one after the other, so the
+indexes of the row block stay in the cache.  The indexes of column images
+(mutual check) are kept for the current column tile only, outside of the
+LRU, and dropped when the next tile starts (end_tile), so they never
+evict the indexes of the row block.
+"""
+from collections import OrderedDict
+
+class DescriptorCache(object):
+    def __init__(self, pack, budget_bytes):
+        self.pack = pack
+        self.budget = budget_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        # indexes of the column images of the current tile
+        self.columns = {}
+        self.columns_size = 0
+        self.peak = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, load):
+        """Value of key, computed with load() when not in the cache"""
+        if key in self.items:
+            value = self.items.pop(key)
+            self.items[key] = value
+            self.hits += 1
+            return value
+        value = load()
+        self.misses += 1
+        self.items[key] = value
+        self.size += value.nbytes
+        self.peak = max(self.peak, self.size + self.columns_size)
+        self.evict(1)
+        return value
+
+    def evict(self, keep):
+        # least recently used first, keep at least the entries just loaded
+        while self.size + self.columns_size > self.budget and len(self.items) > keep:
+            old_key, old_value = self.items.popitem(last=False)
+            self.size -= old_value.nbytes
+            self.evictions += 1
+
+    def column(self, key, load):
+        """Value of key for the current column tile, computed with load() when not there"""
+        if key in self.columns:
+            self.hits += 1
+            return self.columns[key]
+        value = load()
+        self.misses += 1
+        self.columns[key] = value
+        self.columns_size += value.nbytes
+        self.peak = max(self.peak, self.size + self.columns_size)
+        # make room by dropping indexes of earlier row blocks
+        self.evict(0)
+        return value
+
+    def end_tile(self):
+        """Drop the values of the column tile"""
+        self.columns = {}
+        self.columns_size = 0
+
+    def descriptors(self, n):
+        # shared pages of the pack, nothing to decode or to account for
+        return self.pack.image_descriptors(n)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, peak_bytes=self.peak)
+
+def tile_size(budget_bytes, image_bytes, index_bytes, mutual=False):
+    """Images per row block / column tile so that a tile fits the budget
+        image_bytes: bytes of the descriptors of an image
+        index_bytes: bytes of the search index of an image (FlannIndex.nbytes)
+        A row image takes its descriptors and its index, a column image its
+        descriptors, and its index as well with the mutual check.
+    """
+    row_cost = index_bytes + image_bytes
+    column_cost = image_bytes + (index_bytes if mutual else 0)
+    return max(int(budget_bytes // (row_cost + column_cost)), 1)
+
+def tiled_jobs(pairs, tile, min_jobs=1):
+    """Group pairs (j, i) into row blocks of i, split into column tiles of j
+        Row blocks are made smaller than tile if needed for min_jobs jobs.
+        OUTPUT: list of jobs, each a list of column tiles in processing order,
+            each a list of (i, [j, ...])
+    """
+    if not pairs:
+        return []
+    rows = sorted(set(i for j, i in pairs))
+    block = max(min(tile, -(-len(rows) // min_jobs)), 1)
+    row_block = dict((i, n // block) for n, i in enumerate(rows))
+
+    tiles = {}
+    for j, i in pairs:
+        tiles.setdefault((row_block[i], j // tile), {}).setdefault(i, []).append(j)
+    jobs = {}
+    for (r, c), partners in sorted(tiles.items()):
+        jobs.setdefault(r, []).append([(i, sorted(js)) for i, js in sorted(partners.items())])
+    # largest jobs first
+    return sorted(jobs.values(), key=lambda job: sum(len(js) for t in job for i, js in t), reverse=True)
@@ -1,6 +1,12 @@
 
 class MatchingEngine():
     outputFileName = "matches.init.txt"
+    featuresListFileName = "list_features.txt"
+    features_list_add_fn = "list_features.added.txt"
+    # number of processes, set by the Bundler (-t)
+    num_workers = 1
+    # file with the image pairs to match (eg. from image retrieval), None for all pairs
+    candidatePairsFileName = None
     featureExtractionNeeded = True
 
     def __init__(self):
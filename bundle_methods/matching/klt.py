@@ -0,0 +1,175 @@
+"""
+Correspondences of video keyframes from KLT tracking
+
+Made for the features of the 'klt' feature engine (corners without
+descriptors, see features/klt.py).  The corners of every keyframe are
+tracked with pyramidal Lucas-Kanade through all frames of world.avi up to
+the keyframe `window` keyframes ahead.  At every keyframe on the way the
+tracked points are associated with the corners detected there (nearest
+corner within `radius` pixels), which gives the matches of the pair.
+Tracks failing the forward-backward check are dropped.
+
+The video is cut into segments of keyframes tracked by a pool of worker
+processes, each decoding its frames once.  Pairs with at least
+min_matches matches are written to matches.init.txt in the format of
+KeyMatchFull.
+"""
+import os, logging
+import multiprocessing
+
+import numpy as np
+import cv2
+
+from engine import MatchingEngine
+from bundle_methods.features.container import CONTAINER_PREFIX
+from native import write_match_table
+from pack import open_pack
+
+CAP_PROP_POS_FRAMES = 1 # cv2.CAP_PROP_POS_FRAMES
+
+LK_PARAMS = dict(winSize=(21, 21), maxLevel=3,
+                 criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+
+def frame_number(key_fn):
+    return int(os.path.basename(key_fn).split(".")[0])
+
+def track(prev, gray, points, fb_threshold):
+    """Track points (n, 2) from prev to gray
+        OUTPUT: (tracked points, boolean mask of the points kept)
+    """
+    if len(points) == 0:
+        return points, np.zeros(0, dtype=bool)
+    p0 = points.reshape(-1, 1, 2).astype(np.float32)
+    p1, status, err = cv2.calcOpticalFlowPyrLK(prev, gray, p0, None, **LK_PARAMS)
+    back, back_status, err = cv2.calcOpticalFlowPyrLK(gray, prev, p1, None, **LK_PARAMS)
+    fb_error = np.sqrt(((back - p0)**2).sum(axis=-1)).ravel()
+    h, w = gray.shape
+    p1 = p1.reshape(-1, 2)
+    ok = (status.ravel() == 1) & (back_status.ravel() == 1) & (fb_error < fb_threshold)
+    ok &= (p1[:,0] >= 0) & (p1[:,0] < w) & (p1[:,1] >= 0) & (p1[:,1] < h)
+    return p1, ok
+
+def associate(points, corners, radius):
+    """One to one association of tracked points with the nearest detected corner
+        OUTPUT: (indices into points, indices into corners)
+    """
+    if len(points) == 0 or len(corners) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    nearest = np.empty(len(points), dtype=np.int64)
+    dist = np.empty(len(points))
+    # in chunks: (points x corners) distances
+    for start in xrange(0, len(points), 1024):
+        d = ((points[start:start+1024,None,:] - corners[None])**2).sum(axis=-1)
+        nearest[start:start+1024] = d.argmin(axis=1)
+        dist[start:start+1024] = d.min(axis=1)
+    close = np.flatnonzero(dist < radius**2)
+    unique = np.bincount(nearest[close], minlength=len(corners)) == 1
+    close = close[unique[nearest[close]]]
+    return close, nearest[close]
+
+def track_segment(job):
+    """Track the corners of keyframes start..stop-1 through the video
+        OUTPUT: list of (keyframe a, keyframe b, matches (key in a, key in b))
+            with keyframes as positions in frame order
+    """
+    video_path, size, frames, corners, start, stop, settings = job
+    window = settings['window']
+    last = min(stop - 1 + window, len(frames) - 1)
+
+    cap = cv2.VideoCapture(video_path)
+    cap.set(CAP_PROP_POS_FRAMES, frames[start])
+    # tracks started at a keyframe: [keyframe, corner ids, current points]
+    active = []
+    results = []
+    prev = None
+    next_keyframe = start
+    frame_num = frames[start]
+    while frame_num <= frames[last]:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        gray = cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        if prev is not None and active:
+            # all tracks of the segment in one call
+            points, kept = track(prev, gray, np.concatenate([t[2] for t in active]), settings['fb_threshold'])
+            n = 0
+            for t in active:
+                t_kept = kept[n:n+len(t[2])]
+                t[1], t[2] = t[1][t_kept], points[n:n+len(t[2])][t_kept]
+                n += len(t_kept)
+        if frame_num == frames[next_keyframe]:
+            b = next_keyframe
+            for a, ids, points in active:
+                i_points, i_corners = associate(points, corners[b], settings['radius'])
+                results.append((a, b, np.column_stack((ids[i_points], i_corners))))
+            active = [t for t in active if b - t[0] < window and len(t[1]) > 0]
+            if b < stop:
+                active.append([b, np.arange(len(corners[b])), corners[b].copy()])
+            next_keyframe += 1
+            if next_keyframe > last:
+                break
+        prev = gray
+        frame_num += 1
+    cap.release()
+    return results
+
+className = "KltMatching"
+class KltMatching(MatchingEngine):
+    # number of following keyframes the corners of a keyframe are tracked to
+    window = 3
+    # association of tracked points with corners & forward-backward check, in pixels
+    radius = 2.0
+    fb_threshold = 1.0
+    min_matches = 16
+    # world.avi of the recording, set by the Bundler
+    video_path = None
+
+    def __init__(self, distrDir=None):
+        pass
+
+    def match(self):
+        logging.info("\nTracking corners through the video...")
+        if self.video_path is None or not os.path.isfile(self.video_path):
+            raise Exception, "KLT matching needs the video of the keyframes, '%s' does not exist." % self.video_path
+        f = open(self.featuresListFileName, "r")
+        key_files = [os.path.abspath(l.strip()) for l in f if l.strip()]
+        f.close()
+
+        try:
+            frame_number(key_files[0])
+        except ValueError:
+            raise Exception, "KLT matching needs keyframes named by their frame number in the video (-src video)."
+        # keyframes in frame order, corners as (x, y)
+        order = sorted(range(len(key_files)), key=lambda n: frame_number(key_files[n]))
+        frames = [frame_number(key_files[n]) for n in order]
+        pack = open_pack(key_files, CONTAINER_PREFIX, self.num_workers)
+        corners = [np.array(pack.image_keypoints(n)[:,[1, 0]]) for n in order]
+        # corners are detected on the (resized) copies of the keyframes
+        h, w = cv2.imread("%s.jpg" % os.path.splitext(key_files[order[0]])[0]).shape[:2]
+
+        settings = dict(window=self.window, radius=self.radius, fb_threshold=self.fb_threshold)
+        num_segments = min(len(frames), 2*self.num_workers)
+        bounds = [len(frames)*k/num_segments for k in xrange(num_segments+1)]
+        jobs = [(self.video_path, (w, h), frames, corners, bounds[k], bounds[k+1], settings)
+                for k in xrange(num_segments) if bounds[k] < bounds[k+1]]
+
+        pool = multiprocessing.Pool(self.num_workers)
+        matched = []
+        try:
+            for results in pool.imap_unordered(track_segment, jobs):
+                for a, b, matches in results:
+                    if len(matches) < self.min_matches:
+                        continue
+                    j, i = order[a], order[b]
+                    if j > i:
+                        j, i, matches = i, j, matches[:,::-1]
+                    matched.append((j, i, matches))
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        pool.join()
+
+        write_match_table(self.outputFileName, matched)
+        print "Tracked %s keyframe pairs with at least %s matches" %(len(matched), self.min_matches)
@@ -0,0 +1,309 @@
+"""
+Feature matching in Python, a drop-in replacement for KeyMatchFull
+
+The worker processes map the feature container of the SfM directory, in
+the order of the features list (see pack.py).  Pairs are matched in tiles that keep the
+search indexes each worker needs within a memory budget (see descriptors.py).
+For every image one approximate nearest neighbour index (FLANN randomized
+kd-trees) is built and the descriptors of its partner images are matched
+against it:
+    - ratio test: nearest / second nearest distance < ratio
+    - mutual check: the match is also the nearest neighbour the other way
+Pairs with at least min_matches matches are written to matches.init.txt
+in the format of KeyMatchFull, so Bundler reads them unchanged.
+With a match store (see store.py) only pairs not in the store are matched.
+"""
+import os, logging
+import multiprocessing
+
+import numpy as np
+import cv2
+
+from engine import MatchingEngine
+from bundle_methods.features.container import CONTAINER_PREFIX, features_sha1
+from bundle_methods.retrieval import read_pairs
+from bundle_methods.storage import cache_key
+from descriptors import DescriptorCache, tile_size, tiled_jobs
+from pack import open_pack, FeaturePack
+
+FLANN_INDEX_KDTREE = 1
+
+# DescriptorCache of the worker, set once per worker by init_worker()
+_cache = None
+
+def init_worker(budget_bytes, pack_prefix, names):
+    global _cache
+    # map the container in the worker: zero copy, pages shared with the other workers
+    _cache = DescriptorCache(FeaturePack(pack_prefix, names), budget_bytes)
+
+def image_sha1(n):
+    """Content hash of the features of image n, for the match store"""
+    return features_sha1(_cache.pack.image_keypoints(n), _cache.pack.image_descriptors(n))
+
+class FlannIndex(object):
+    """FLANN randomized kd-trees over a set of descriptors"""
+    def __init__(self, descriptors, trees):
+        # the index does not copy the data: keep a reference to it
+        self.data = descriptors.astype(np.float32)
+        self.index = cv2.flann_Index(self.data, dict(algorithm=FLANN_INDEX_KDTREE, trees=trees))
+
+    @staticmethod
+    def estimate_nbytes(descriptor_bytes):
+        """Bytes of the index of descriptor_bytes of uint8 descriptors:
+            a float32 copy of the descriptors & about as much for the trees
+        """
+        return 2*4*descriptor_bytes
+
+    @property
+    def nbytes(self):
+        return FlannIndex.estimate_nbytes(self.data.size)
+
+    def search(self, query, k, checks):
+        """OUTPUT: (indices, squared distances) of the k nearest neighbours"""
+        return self.index.knnSearch(query.astype(np.float32), k, params=dict(checks=checks))
+
+def match_descriptors(query, train, train_index, settings, query_index=None):
+    """Match query descriptors against train descriptors (indexed by train_index)
+        query_index: FlannIndex of the query descriptors for the mutual check,
+            built here if None (workers pass the one of their cache)
+        OUTPUT: int array (n, 2) of (query key, train key)
+    """
+    nn, dist = train_index.search(query, 2, settings['checks'])
+    ok = dist[:,0] < settings['ratio']**2 * dist[:,1]
+    matches = np.column_stack((np.flatnonzero(ok), nn[ok,0])).astype(np.int64)
+
+    if len(matches) == 0:
+        return matches
+    if settings['mutual']:
+        # nearest query key of every matched train key
+        if query_index is None:
+            query_index = FlannIndex(query, settings['trees'])
+        back, back_dist = query_index.search(train[matches[:,1]], 1, settings['checks'])
+        matches = matches[back[:,0] == matches[:,0]]
+    else:
+        # like KeyMatchFull: drop train keys matched more than once
+        counts = np.bincount(matches[:,1], minlength=len(train))
+        matches = matches[counts[matches[:,1]] == 1]
+    return matches
+
+def match_tiles(job):
+    """Match the pairs of a job of tiled_jobs: images i with their partners js (all < i)
+        OUTPUT: (list of (j, i, matches) for all pairs, process id, cache statistics)
+            pairs with too few matches are filtered by the caller
+    """
+    tiles, settings = job
+    no_matches = np.zeros((0, 2), dtype=np.int64)
+    results = []
+    for partners in tiles:
+        for i, js in partners:
+            train = _cache.descriptors(i)
+            if len(train) < 2:
+                results.extend((j, i, no_matches) for j in js)
+                continue
+            train_index = _cache.get(("index", i), lambda: FlannIndex(train, settings['trees']))
+            for j in js:
+                query = _cache.descriptors(j)
+                if len(query) == 0:
+                    results.append((j, i, no_matches))
+                else:
+                    # the index of j for the mutual check is kept for this column tile only
+                    query_index = None
+                    if settings['mutual']:
+                        query_index = _cache.column(("index", j), lambda: FlannIndex(query, settings['trees']))
+                    results.append((j, i, match_descriptors(query, train, train_index, settings, query_index)))
+        _cache.end_tile()
+    return results, os.getpid(), _cache.stats()
+
+className = "NativeMatching"
+class NativeMatching(MatchingEngine):
+    ratio = 0.6
+    mutual = True
+    min_matches = 16
+    # FLANN parameters: number of randomized kd-trees & leaves checked per query
+    trees = 4
+    checks = 64
+    # parameters that change the matches (see cache_key)
+    params = ("ratio", "mutual", "trees", "checks")
+    # MatchStore instance or None, set by the Bundler (-ms)
+    match_store = None
+    # memory for descriptors & indexes of all workers together, set by the Bundler (-mm)
+    memory_budget_mb = 4096
+    # memory-mapped keypoints & descriptors of all images (see features/container.py)
+    featurePackPrefix = CONTAINER_PREFIX
+
+    def __init__(self, distrDir=None):
+        pass
+
+    def settings(self):
+        return dict((p, getattr(self, p)) for p in self.params)
+
+    def cache_key(self):
+        """Identifies the matcher and its parameters, for the match store"""
+        return cache_key(self)
+
+    def key_files(self, features_list_fn):
+        f = open(features_list_fn, "r")
+        key_files = [os.path.abspath(l.strip()) for l in f if l.strip()]
+        f.close()
+        return key_files
+
+    def candidate_pairs(self, key_files):
+        """Image pairs (j, i) with j < i (indices into key_files) to match,
+            from the candidate pairs file if there is one,
+            otherwise all pairs like KeyMatchFull
+        """
+        if self.candidatePairsFileName is not None:
+            return read_pairs(self.candidatePairsFileName)
+        return [(j, i) for i in xrange(len(key_files)) for j in xrange(i)]
+
+    def match(self):
+        logging.info("\nPerforming feature matching...")
+        key_files = self.key_files(self.featuresListFileName)
+        pairs = self.candidate_pairs(key_files)
+        matched = self.match_pairs(key_files, pairs)
+        self.write_matches(matched, "w")
+        print "Matched %s of %s image pairs" %(len(matched), len(pairs))
+
+    def match_added(self):
+        """Match only the added images (features_list_add_fn) with the images
+            of the reconstruction and with each other, and append the new
+            pairs to the existing match table.  Added images are numbered
+            after the images of the reconstruction, like Bundler's --add_images.
+        """
+        logging.info("\nPerforming feature matching of the added images...")
+        old_key_files = self.key_files(self.featuresListFileName)
+        key_files = old_key_files + self.key_files(self.features_list_add_fn)
+        done = set(read_match_pairs(self.outputFileName)) if os.path.exists(self.outputFileName) else set()
+        pairs = [(j, i) for j, i in self.candidate_pairs(key_files)
+                 if i >= len(old_key_files) and (j, i) not in done]
+        matched = self.match_pairs(key_files, pairs)
+        self.write_matches(matched, "a")
+        print "Matched %s of %s new image pairs" %(len(matched), len(pairs))
+
+    def match_pairs(self, key_files, pairs):
+        """Match pairs, pairs found in the match store are not matched again
+            OUTPUT: list of (j, i, matches) for the pairs with enough matches,
+                with the match store matches are Records read when written
+        """
+        store = self.match_store
+        matched = []
+        pack = open_pack(key_files, self.featurePackPrefix, self.num_workers)
+        budget = self.memory_budget_mb*1024*1024 / self.num_workers
+        worker_args = (budget, pack.prefix, pack.names)
+        if store is not None:
+            pool = multiprocessing.Pool(self.num_workers, init_worker, worker_args)
+            try:
+                hashes = pool.map(image_sha1, xrange(len(key_files)))
+            finally:
+                pool.close()
+                pool.join()
+            keys = dict(((j, i), store.key(hashes[j], hashes[i], self)) for j, i in pairs)
+            missing = []
+            for j, i in pairs:
+                record = store.fetch(keys[(j, i)])
+                if record is None:
+                    missing.append((j, i))
+                elif len(record) >= self.min_matches:
+                    matched.append((j, i, record))
+            print "Match store (%s): %s of %s pairs found" %(store.store_dir, len(pairs)-len(missing), len(pairs))
+            pairs = missing
+        if not pairs:
+            return matched
+
+        image_bytes = max(pack.nbytes / max(len(pack), 1), 1)
+        tile = tile_size(budget, image_bytes, FlannIndex.estimate_nbytes(image_bytes), self.mutual)
+        jobs = [(job, self.settings()) for job in tiled_jobs(pairs, tile, self.num_workers)]
+        cache_stats = {}
+
+        pool = multiprocessing.Pool(self.num_workers, init_worker, worker_args)
+        try:
+            for results, pid, stats in pool.imap_unordered(match_tiles, jobs):
+                # statistics are totals of the worker so far
+                cache_stats[pid] = stats
+                for j, i, matches in results:
+                    if store is not None:
+                        matches = store.store(keys[(j, i)], matches)
+                    if len(matches) >= self.min_matches:
+                        matched.append((j, i, matches))
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        pool.join()
+        self.report_cache(cache_stats.values(), tile)
+        return matched
+
+    def report_cache(self, worker_stats, tile):
+        self.cache_stats = dict((k, sum(s[k] for s in worker_stats)) for k in ("hits", "misses", "evictions"))
+        self.cache_stats['peak_bytes'] = max([s['peak_bytes'] for s in worker_stats] or [0])
+        lookups = max(self.cache_stats['hits'] + self.cache_stats['misses'], 1)
+        print ("\nSearch index cache report (%s MB for %s workers, tiles of %s images):\n"
+               "\tHit rate: %.1f%%\n"
+               "\tBuilt: %s\n"
+               "\tEvicted: %s\n"
+               "\tPeak per worker: %.1f MB\n") %(self.memory_budget_mb, self.num_workers, tile,
+            100.0*self.cache_stats['hits']/lookups, self.cache_stats['misses'],
+            self.cache_stats['evictions'], self.cache_stats['peak_bytes']/1048576.0)
+
+    def write_matches(self, matched, mode="w"):
+        write_match_table(self.outputFileName, matched, mode)
+
+def write_match_table(fn, matched, mode="w"):
+    """Write (j, i, matches) in the format of KeyMatchFull,
+        in the same order: by second image, then first image
+    """
+    matched.sort(key=lambda m: (m[1], m[0]))
+    f = open(fn, mode)
+    for j, i, matches in matched:
+        matches = np.asarray(matches)
+        f.write("%d %d\n%d\n" %(j, i, len(matches)))
+        # one format for all rows, np.savetxt formats row by row
+        f.write(("%d %d\n" * len(matches)) % tuple(matches.ravel().tolist()))
+    f.close()
+
+def read_match_table(fn):
+    """Pairs of a match table written by KeyMatchFull or write_match_table
+        OUTPUT: generator of (j, i, int array (n, 2) of (key in j, key in i))
+    """
+    f = open(fn, "r")
+    try:
+        while True:
+            header = f.readline().split()
+            if len(header) < 2:
+                break
+            num_matches = int(f.readline())
+            lines = "".join(f.readline() for n in xrange(num_matches))
+            matches = np.fromstring(lines, dtype=np.int64, sep=" ").reshape(-1, 2)
+            yield int(header[0]), int(header[1]), matches
+    finally:
+        f.close()
+
+def read_match_counts(fn):
+    """Image pairs & their number of matches (j, i, matches) in a match table"""
+    f = open(fn, "r")
+    try:
+        while True:
+            header = f.readline().split()
+            if len(header) < 2:
+                break
+            count = int(f.readline())
+            for n in xrange(count):
+                f.readline()
+            yield int(header[0]), int(header[1]), count
+    finally:
+        f.close()
+
+def read_match_pairs(fn):
+    """Image pairs (j, i) in a match table written by KeyMatchFull or write_matches"""
+    f = open(fn, "r")
+    try:
+        while True:
+            header = f.readline().split()
+            if len(header) < 2:
+                break
+            for n in xrange(int(f.readline())):
+                f.readline()
+            yield int(header[0]), int(header[1])
+    finally:
+        f.close()
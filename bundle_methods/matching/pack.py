@@ -0,0 +1,84 @@
+"""
+Keypoints & descriptors of the images of a features list, memory-mapped
+
+A FeaturePack is a view of the feature container of the SfM directory
+(see features/container.py) in the order of a features list: image n is
+the n-th key file of the list.  Worker processes map the container
+read-only, the pages are shared by all workers through the page cache,
+so memory does not grow with the number of workers and a worker starts
+without parsing any key file.
+
+Feature extractors write the container directly.  Images of the list
+missing from it (key files written by other tools) are decoded from their
+Lowe key files in parallel and appended to it, and decoded again when
+the key file changed after it was decoded.
+"""
+import os
+import multiprocessing
+
+import numpy as np
+
+from bundle_methods.features.lowe import read_lowe, key_file
+from bundle_methods.features.container import FeatureContainer, append_features, update_index, image_name
+
+class FeaturePack(object):
+    def __init__(self, prefix, names):
+        self.container = FeatureContainer(prefix)
+        self.prefix = self.container.prefix
+        self.names = names
+        rows = np.array([self.container.rows(name) for name in names], dtype=np.int64).reshape(-1, 2)
+        self.starts, self.stops = rows[:,0], rows[:,1]
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def nbytes(self):
+        """Bytes of the descriptors of the images of the pack"""
+        return int((self.stops - self.starts).sum()) * self.container.descriptors.shape[1]
+
+    def image_descriptors(self, n):
+        return self.container.descriptors[self.starts[n]:self.stops[n]]
+
+    def image_keypoints(self, n):
+        return self.container.keypoints[self.starts[n]:self.stops[n]]
+
+# lock of the container, shared with the workers of the pool by init_worker()
+_lock = None
+
+def init_worker(lock):
+    global _lock
+    _lock = lock
+
+def pack_image(job):
+    """Decode one key file and append it to the container
+        OUTPUT: index entry of the image
+    """
+    prefix, fn = job
+    keypoints, descriptors = read_lowe(fn)
+    row, count = append_features(prefix, keypoints, descriptors, _lock)
+    return image_name(fn), row, count, os.path.getmtime(key_file(fn))
+
+def open_pack(key_files, prefix, num_workers=8):
+    """FeaturePack of key_files, decoding the key files missing from the container"""
+    prefix = os.path.abspath(prefix)
+    index = FeatureContainer(prefix).index
+    missing = []
+    for fn in key_files:
+        entry = index.get(image_name(fn))
+        if entry is None:
+            if not os.path.exists(key_file(fn)):
+                raise Exception, "No features of '%s' in the feature container or a key file" % image_name(fn)
+            missing.append(fn)
+        elif entry[2] > 0 and os.path.exists(key_file(fn)) and os.path.getmtime(key_file(fn)) > entry[2]:
+            missing.append(fn)
+
+    if missing:
+        pool = multiprocessing.Pool(num_workers, init_worker, (multiprocessing.Lock(),))
+        try:
+            entries = pool.map(pack_image, [(prefix, fn) for fn in missing], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        update_index(prefix, entries)
+    return FeaturePack(prefix, [image_name(fn) for fn in key_files])
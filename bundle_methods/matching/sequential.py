@@ -0,0 +1,65 @@
+"""
+Sequential matching for frames of a video (named "%08d.jpg" by frame number)
+
+Consecutive frames overlap, frames far apart in time rarely do.  Instead
+of all pairs, every frame is matched with the next `window` frames in
+frame number order, which is linear in the number of frames.  Every
+`loop_stride`-th frame is also matched with `loop_candidates` earlier
+`loop_stride`-th frames outside the window, spread evenly over the time
+before it, to close loops when the wearer comes back to a place seen
+before; this keeps the pairs linear in the number of frames too.
+Candidate pairs from image retrieval (-r), ranked by appearance instead
+of time, are matched as well.
+
+Matching itself is done by NativeMatching, so matches.init.txt has the
+format of KeyMatchFull.
+"""
+import os
+
+from native import NativeMatching
+
+def frame_number(key_file):
+    name = os.path.basename(key_file).split(".")[0]
+    try:
+        return int(name)
+    except ValueError:
+        return None
+
+def sequential_pairs(frames, window, loop_stride, loop_candidates):
+    """Pairs of positions in frames (list of frame numbers)
+        OUTPUT: set of (j, i) with j < i
+    """
+    order = sorted(range(len(frames)), key=lambda n: frames[n])
+    pairs = set()
+    for a in xrange(len(order)):
+        for b in xrange(a+1, min(a+1+window, len(order))):
+            pairs.add((min(order[a], order[b]), max(order[a], order[b])))
+    if loop_stride:
+        for a in xrange(0, len(order), loop_stride):
+            # the earlier stride frames outside the window are 0, loop_stride, ... < a - window,
+            # every step-th of them is taken back from the most recent one
+            earlier = max(0, -(-(a - window) // loop_stride))
+            step = max(1, -(-earlier // max(1, loop_candidates)))
+            for t in xrange(min(loop_candidates, -(-earlier // step))):
+                b = (earlier - 1 - t * step) * loop_stride
+                pairs.add((min(order[a], order[b]), max(order[a], order[b])))
+    return pairs
+
+className = "SequentialMatching"
+class SequentialMatching(NativeMatching):
+    # number of following frames each frame is matched with
+    window = 10
+    # match every loop_stride-th frame with earlier ones (0: no loop closure)
+    loop_stride = 10
+    # number of earlier loop_stride-th frames each of them is matched with
+    loop_candidates = 8
+
+    def candidate_pairs(self, key_files):
+        frames = [frame_number(fn) for fn in key_files]
+        if None in frames:
+            # not named by frame number: keep the order of the features list
+            frames = range(len(key_files))
+        pairs = sequential_pairs(frames, self.window, self.loop_stride, self.loop_candidates)
+        if self.candidatePairsFileName is not None:
+            pairs.update(NativeMatching.candidate_pairs(self, key_files))
+        return sorted(pairs)
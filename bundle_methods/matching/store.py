@@ -0,0 +1,61 @@
+"""
+Persistent on-disk store of pairwise feature matches
+
+One record per image pair, keyed on the content hashes of the features
+of the two images and the matcher (class name and parameters), so matches survive
+new SfM directories, other bundler options and other frame subsets.
+Pairs with too few matches are stored as well, they are not matched again.
+
+A record is the raw array of matches as uint32 (query key, train key),
+8 bytes per match.  Records are loaded lazily: match tables are written
+from the store one pair at a time.
+"""
+import os, hashlib
+
+import numpy as np
+
+from bundle_methods.storage import write_file
+
+class Record(object):
+    """Matches of a pair in the store, read when converted to an array"""
+    def __init__(self, path):
+        self.path = path
+
+    def __len__(self):
+        return os.path.getsize(self.path) // 8
+
+    def __array__(self, dtype=None):
+        matches = np.fromfile(self.path, dtype=np.uint32).reshape(-1, 2)
+        return matches if dtype is None else matches.astype(dtype)
+
+class MatchStore(object):
+    def __init__(self, store_dir):
+        self.store_dir = os.path.abspath(os.path.expanduser(store_dir))
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def key(self, hash_j, hash_i, matching_engine):
+        return hashlib.sha1("%s %s %s" %(hash_j, hash_i, matching_engine.cache_key())).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.store_dir, key[:2], "%s.matches" %key)
+
+    def fetch(self, key):
+        """Record of the pair or None if it is not in the store"""
+        path = self.path(key)
+        if os.path.exists(path):
+            return Record(path)
+        return None
+
+    def store(self, key, matches):
+        """Write the matches of a pair (replaced atomically, see storage.write_file)
+            OUTPUT: Record of the pair
+        """
+        dst = self.path(key)
+        if not os.path.isdir(os.path.dirname(dst)):
+            try:
+                os.makedirs(os.path.dirname(dst))
+            except OSError:
+                pass # created meanwhile
+        write_file(dst, np.asarray(matches, dtype=np.uint32).tostring())
+        return Record(dst)
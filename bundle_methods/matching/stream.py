@@ -0,0 +1,125 @@
+"""
+Matching of photos while features are extracted (-st)
+
+Photos are matched on the pool of the feature extraction: as soon as a
+worker has appended the features of a photo to the feature container,
+every candidate pair of the photo whose other side is ready as well is
+handed to the same pool.  Feature extraction is fed a few photos ahead
+only (see Bundler.prepare_photos), so match jobs are not queued behind
+all the photos, and extraction and matching overlap.
+
+Pairs are matched like NativeMatching: query image j, indexed image i,
+j < i in the order of the features list, so the matches of a pair do not
+depend on which of its photos was extracted first.
+"""
+import numpy as np
+
+from bundle_methods.features.container import DESCRIPTOR_LENGTH, image_name, features_sha1
+from native import FlannIndex, match_descriptors
+
+def image_descriptors(prefix, row, count):
+    """Descriptors of an image, mapped from the container while it is written"""
+    if count == 0:
+        return np.zeros((0, DESCRIPTOR_LENGTH), dtype=np.uint8)
+    return np.memmap("%s.descriptors" % prefix, dtype=np.uint8, mode="r",
+                     offset=row*DESCRIPTOR_LENGTH, shape=(count, DESCRIPTOR_LENGTH))
+
+def match_ready(job):
+    """Match pairs of images whose features are in the container
+        job: (container prefix, {image: (first row, rows)}, pairs [(j, i)], settings)
+        OUTPUT: list of (j, i, matches) for all pairs
+    """
+    prefix, rows, pairs, settings = job
+    no_matches = np.zeros((0, 2), dtype=np.int64)
+    results = []
+    indexes = {}
+    for j, i in sorted(pairs, key=lambda pair: (pair[1], pair[0])):
+        train = image_descriptors(prefix, *rows[i])
+        query = image_descriptors(prefix, *rows[j])
+        if len(train) < 2 or len(query) == 0:
+            results.append((j, i, no_matches))
+            continue
+        if i not in indexes:
+            indexes[i] = FlannIndex(train, settings['trees'])
+        # the index of j for the mutual check is kept like the train indexes
+        query_index = None
+        if settings['mutual']:
+            if j not in indexes:
+                indexes[j] = FlannIndex(query, settings['trees'])
+            query_index = indexes[j]
+        results.append((j, i, match_descriptors(query, train, indexes[i], settings, query_index)))
+    return results
+
+class PairScheduler(object):
+    """Candidate pairs that become ready as their images are extracted"""
+    def __init__(self, pairs):
+        self.partners = {}
+        for j, i in pairs:
+            self.partners.setdefault(j, []).append(i)
+            self.partners.setdefault(i, []).append(j)
+        self.ready = set()
+
+    def add(self, n):
+        """Mark image n ready
+            OUTPUT: the pairs (j, i) of n whose images are both ready
+        """
+        self.ready.add(n)
+        return [(min(n, k), max(n, k)) for k in self.partners.get(n, ()) if k in self.ready]
+
+class StreamMatching(object):
+    """Match jobs of the photos of a features list, handed to pool as the photos are extracted
+        key_files: the features list the photos will have (matches are numbered by it)
+        engine: NativeMatching instance, gives the candidate pairs & the matcher settings
+    """
+    def __init__(self, pool, prefix, key_files, engine, pairs_per_job=8):
+        self.pool = pool
+        self.prefix = prefix
+        self.engine = engine
+        self.pairs_per_job = pairs_per_job
+        self.position = dict((image_name(fn), n) for n, fn in enumerate(key_files))
+        self.scheduler = PairScheduler(engine.candidate_pairs(key_files))
+        self.num_pairs = sum(len(k) for k in self.scheduler.partners.values()) // 2
+        self.rows = {}
+        self.hashes = {}
+        self.keys = {}
+        self.matched = []
+        self.pending = []
+
+    def add(self, name, rows):
+        """The features of photo name are in the container at rows (first row, rows)"""
+        n = self.position[name]
+        self.rows[n] = rows
+        pairs = self.scheduler.add(n)
+        store = self.engine.match_store
+        if store is not None:
+            row, count = rows
+            keypoints = np.memmap("%s.keypoints" % self.prefix, dtype=np.float32, mode="r",
+                                  offset=row*16, shape=(count, 4)) if count else np.zeros((0, 4), np.float32)
+            self.hashes[n] = features_sha1(keypoints, image_descriptors(self.prefix, row, count))
+            missing = []
+            for j, i in pairs:
+                self.keys[(j, i)] = store.key(self.hashes[j], self.hashes[i], self.engine)
+                record = store.fetch(self.keys[(j, i)])
+                if record is None:
+                    missing.append((j, i))
+                elif len(record) >= self.engine.min_matches:
+                    self.matched.append((j, i, record))
+            pairs = missing
+        for start in xrange(0, len(pairs), self.pairs_per_job):
+            chunk = pairs[start:start+self.pairs_per_job]
+            rows = dict((k, self.rows[k]) for pair in chunk for k in pair)
+            self.pending.append(self.pool.apply_async(match_ready, ((self.prefix, rows, chunk, self.engine.settings()),)))
+
+    def finish(self):
+        """Wait for all match jobs
+            OUTPUT: list of (j, i, matches) for the pairs with enough matches
+        """
+        store = self.engine.match_store
+        for result in self.pending:
+            for j, i, matches in result.get():
+                if store is not None:
+                    matches = store.store(self.keys[(j, i)], matches)
+                if len(matches) >= self.engine.min_matches:
+                    self.matched.append((j, i, matches))
+        self.pending = []
+        return self.matched
@@ -0,0 +1,110 @@
+"""
+Multi-view tracks of a match table, with track filtering
+
+The keypoints of all images are the nodes of a graph, the matches of the
+match table its edges.  A track is a connected component, found with a
+union-find over all edges at once: every round hooks the larger root of
+each edge under the smaller one, then pointer jumping flattens the trees.
+
+Tracks holding two keypoints of the same image are inconsistent (Bundler
+would discard them after building them), tracks seen in fewer than
+min_track_length images are short.  Both are removed: the match table is
+rewritten with the matches inside the remaining tracks only, pairs left
+with fewer than min_matches matches are dropped.  The original table is
+kept next to it (.untracked.txt), and the number of tracks of every
+length is written to a report.
+"""
+import os, logging
+
+import numpy as np
+
+from native import read_match_table, write_match_table
+from bundle_methods.storage import replace_file
+
+def find_roots(num_nodes, u, v):
+    """Union-find of the edges (u, v)
+        OUTPUT: root (smallest node) of the component of every node
+    """
+    parent = np.arange(num_nodes)
+    while True:
+        pu, pv = parent[u], parent[v]
+        differ = pu != pv
+        if not differ.any():
+            return parent
+        # hook the larger root under the smaller one
+        np.minimum.at(parent, np.maximum(pu, pv)[differ], np.minimum(pu, pv)[differ])
+        # pointer jumping until every node points at its root
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+def build_tracks(pairs):
+    """Tracks of pairs [(j, i, matches)]
+        OUTPUT: (image offsets of the nodes, root of every node, edges u, edges v)
+    """
+    # node ids: keys of image n are offsets[n]..offsets[n+1]-1
+    num_images = max(max(j, i) for j, i, matches in pairs) + 1
+    num_keys = np.zeros(num_images, dtype=np.int64)
+    for j, i, matches in pairs:
+        if len(matches):
+            num_keys[j] = max(num_keys[j], matches[:,0].max() + 1)
+            num_keys[i] = max(num_keys[i], matches[:,1].max() + 1)
+    offsets = np.concatenate(([0], np.cumsum(num_keys)))
+
+    u = np.concatenate([offsets[j] + matches[:,0] for j, i, matches in pairs])
+    v = np.concatenate([offsets[i] + matches[:,1] for j, i, matches in pairs])
+    return offsets, find_roots(int(offsets[-1]), u, v), u, v
+
+def track_lengths(offsets, roots, nodes):
+    """Images & keypoints of the tracks of nodes
+        OUTPUT: (track roots, number of images, number of keypoints)
+    """
+    images = np.searchsorted(offsets, nodes, side="right") - 1
+    # distinct (track, image) pairs give the images of every track
+    track_images = np.unique(roots[nodes] * len(offsets) + images)
+    tracks, num_images = np.unique(track_images // len(offsets), return_counts=True)
+    num_keys = np.bincount(np.searchsorted(tracks, roots[nodes]), minlength=len(tracks))
+    return tracks, num_images, num_keys
+
+def filter_match_table(match_table_fn, report_fn, min_track_length=3, min_matches=16):
+    """Remove the matches of inconsistent & short tracks from match_table_fn
+        The original match table is renamed to <match_table_fn>.untracked.txt
+        OUTPUT: dict of track statistics
+    """
+    logging.info("\nBuilding tracks...")
+    pairs = [(j, i, matches) for j, i, matches in read_match_table(match_table_fn) if len(matches)]
+    if not pairs:
+        return dict(tracks=0, consistent=0, kept=0, mean_length=0.0, pairs=0, kept_pairs=0, matches=0, kept_matches=0)
+    offsets, roots, u, v = build_tracks(pairs)
+    nodes = np.unique(np.concatenate((u, v)))
+    tracks, num_images, num_keys = track_lengths(offsets, roots, nodes)
+
+    consistent = num_images == num_keys
+    good = consistent & (num_images >= min_track_length)
+    good_roots = np.zeros(len(roots), dtype=bool)
+    good_roots[tracks[good]] = True
+
+    report = open(report_fn, "w")
+    report.write("# track_length tracks inconsistent_tracks\n")
+    for length in xrange(2, int(num_images.max()) + 1):
+        report.write("%d %d %d\n" %(length, (num_images[consistent] == length).sum(), (num_images[~consistent] == length).sum()))
+    report.close()
+
+    # u and v of an edge are in the same track
+    keep = good_roots[roots[u]]
+    kept = []
+    start = 0
+    for j, i, matches in pairs:
+        pair_keep = keep[start:start+len(matches)]
+        start += len(matches)
+        if pair_keep.sum() >= min_matches:
+            kept.append((j, i, matches[pair_keep]))
+    replace_file(match_table_fn, "%s.untracked.txt" % os.path.splitext(match_table_fn)[0])
+    write_match_table(match_table_fn, kept)
+
+    return dict(tracks=len(tracks), consistent=int(consistent.sum()), kept=int(good.sum()),
+                mean_length=float(num_images[good].mean()) if good.any() else 0.0,
+                pairs=len(pairs), kept_pairs=len(kept),
+                matches=len(u), kept_matches=sum(len(matches) for j, i, matches in kept))
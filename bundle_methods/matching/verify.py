@@ -0,0 +1,213 @@
+"""
+Geometric verification of a match table with RANSAC
+
+Every pair of the match table is fit with a fundamental matrix (normalized
+8-point algorithm) or a homography (4-point DLT).  Hypotheses are
+generated and scored in batches: one call to numpy's stacked SVD solves a
+batch of samples, and the errors of all matches under all hypotheses of
+the batch are computed at once.  The best model is refit on its inliers.
+
+Pairs are verified in a pool of worker processes, a task is a chunk of
+pairs.  Pairs with fewer than min_inliers inliers or an inlier ratio
+below min_inlier_ratio are dropped, outlier matches are removed from
+the others.  The pruned table replaces the match table, the original is
+kept next to it (.unverified.txt), and the number of matches & inliers
+of every pair is written to a report.
+"""
+import os, logging
+import multiprocessing
+
+import numpy as np
+
+from native import read_match_table, write_match_table
+from bundle_methods.storage import replace_file
+from pack import open_pack, FeaturePack
+from bundle_methods.features.container import CONTAINER_PREFIX
+
+SAMPLE_SIZE = {"fundamental": 8, "homography": 4}
+
+# FeaturePack of the images of the features list, set once per worker by init_worker()
+_pack = None
+
+def init_worker(pack_prefix, names):
+    global _pack
+    _pack = FeaturePack(pack_prefix, names)
+
+def image_points(n, keys):
+    """(x, y) coordinates of keypoints keys of image n"""
+    # Lowe's keypoints are (y, x, scale, orientation)
+    return _pack.image_keypoints(n)[keys][:,[1, 0]].astype(np.float64)
+
+def normalization(points):
+    """Similarity moving the centroid to 0 & the mean distance to sqrt(2)"""
+    mean = points.mean(axis=0)
+    dist = np.sqrt(((points - mean)**2).sum(axis=1)).mean()
+    s = np.sqrt(2) / max(dist, 1e-12)
+    return np.array([[s, 0, -s*mean[0]], [0, s, -s*mean[1]], [0, 0, 1]])
+
+def homogeneous(points):
+    return np.column_stack((points, np.ones(len(points))))
+
+def null_vectors(A):
+    """Least squares solution of A x = 0 for a stack of matrices A"""
+    return np.linalg.svd(A)[2][...,-1,:]
+
+def fit_fundamental(x1, x2):
+    """Normalized 8-point algorithm for stacks of samples
+        x1, x2: (batch, m, 3) normalized homogeneous points, m >= 8
+        OUTPUT: (batch, 3, 3) rank 2 fundamental matrices
+    """
+    a = x2[...,:,None] * x1[...,None,:]
+    F = null_vectors(a.reshape(a.shape[:-2] + (9,))).reshape(-1, 3, 3)
+    u, s, vt = np.linalg.svd(F)
+    s[:,2] = 0
+    return np.matmul(u * s[:,None,:], vt)
+
+def fundamental_errors(F, x1, x2):
+    """Sampson distance (squared, pixels) of all matches under all hypotheses
+        F: (batch, 3, 3), x1, x2: (n, 3)
+        OUTPUT: (batch, n)
+    """
+    Fx1 = np.matmul(F, x1.T)
+    Ftx2 = np.matmul(F.transpose(0, 2, 1), x2.T)
+    x2Fx1 = (x2.T[None] * Fx1).sum(axis=1)
+    denom = Fx1[:,0]**2 + Fx1[:,1]**2 + Ftx2[:,0]**2 + Ftx2[:,1]**2
+    return x2Fx1**2 / np.maximum(denom, 1e-12)
+
+def fit_homography(x1, x2):
+    """DLT for stacks of samples
+        x1, x2: (batch, m, 3) normalized homogeneous points, m >= 4
+        OUTPUT: (batch, 3, 3) homographies mapping x1 to x2
+    """
+    zeros = np.zeros_like(x1)
+    rows_u = np.concatenate((-x1, zeros, x1 * x2[...,0:1]), axis=-1)
+    rows_v = np.concatenate((zeros, -x1, x1 * x2[...,1:2]), axis=-1)
+    A = np.concatenate((rows_u, rows_v), axis=-2)
+    return null_vectors(A).reshape(-1, 3, 3)
+
+def homography_errors(H, x1, x2):
+    """Squared transfer error (pixels) of all matches under all hypotheses"""
+    p = np.matmul(H, x1.T)
+    w = p[:,2]
+    w = np.where(np.abs(w) < 1e-12, 1e-12, w)
+    return (p[:,0]/w - x2[:,0])**2 + (p[:,1]/w - x2[:,1])**2
+
+MODELS = {
+    "fundamental": (fit_fundamental, fundamental_errors),
+    "homography": (fit_homography, homography_errors),
+}
+
+def ransac(p1, p2, settings, rs):
+    """Robust fit of the model to matched points p1, p2 (n, 2)
+        OUTPUT: boolean inlier mask
+    """
+    model = settings['model']
+    fit, errors = MODELS[model]
+    sample_size = SAMPLE_SIZE[model]
+    threshold = settings['threshold']**2
+    n = len(p1)
+
+    T1, T2 = normalization(p1), normalization(p2)
+    x1, x2 = homogeneous(p1), homogeneous(p2)
+    n1, n2 = np.dot(x1, T1.T), np.dot(x2, T2.T)
+
+    def denormalize(M):
+        if model == "fundamental":
+            return np.matmul(T2.T, np.matmul(M, T1))
+        return np.matmul(np.linalg.inv(T2), np.matmul(M, T1))
+
+    best = np.zeros(n, dtype=bool)
+    iterations, max_iterations = 0, settings['max_iterations']
+    batch = settings['batch_size']
+    while iterations < max_iterations:
+        # sample_size distinct matches for every hypothesis of the batch
+        samples = np.argsort(rs.rand(batch, n), axis=1)[:,:sample_size]
+        M = denormalize(fit(n1[samples], n2[samples]))
+        inliers = errors(M, x1, x2) < threshold
+        counts = inliers.sum(axis=1)
+        k = counts.argmax()
+        if counts[k] > best.sum():
+            best = inliers[k]
+            # adaptive number of iterations for the inlier ratio found so far
+            w = counts[k] / float(n)
+            if w >= 1.0:
+                break
+            needed = np.log(1 - settings['confidence']) / np.log(max(1 - w**sample_size, 1e-12))
+            max_iterations = min(settings['max_iterations'], int(np.ceil(needed)))
+        iterations += batch
+
+    if best.sum() >= sample_size:
+        # refit on all inliers
+        M = denormalize(fit(n1[best][None], n2[best][None]))
+        refined = errors(M, x1, x2)[0] < threshold
+        if refined.sum() >= best.sum():
+            best = refined
+    return best
+
+def verify_pairs(job):
+    """Verify a chunk of pairs
+        OUTPUT: list of (j, i, number of matches, inlier matches)
+    """
+    pairs, settings = job
+    results = []
+    for j, i, matches in pairs:
+        if len(matches) < max(settings['min_inliers'], SAMPLE_SIZE[settings['model']]):
+            results.append((j, i, len(matches), matches[:0]))
+            continue
+        rs = np.random.RandomState((settings['seed'] + 7919*j + i) % (2**32))
+        inliers = ransac(image_points(j, matches[:,0]), image_points(i, matches[:,1]), settings, rs)
+        results.append((j, i, len(matches), matches[inliers]))
+    return results
+
+def chunks(pairs, size):
+    for start in xrange(0, len(pairs), size):
+        yield pairs[start:start+size]
+
+def verify_match_table(features_list_fn, match_table_fn, report_fn, model="fundamental",
+                       threshold=4.0, min_inliers=16, min_inlier_ratio=0.1, num_workers=8, confidence=0.999,
+                       max_iterations=2000, batch_size=128, seed=0, pack_prefix=CONTAINER_PREFIX):
+    """Verify the pairs of match_table_fn (key indices into the key files of features_list_fn)
+        The original match table is renamed to <match_table_fn>.unverified.txt
+        Keypoints are read from the feature container next to the features list (see pack.py)
+        OUTPUT: (number of pairs kept, number of pairs verified)
+    """
+    logging.info("\nPerforming geometric verification (%s)..." % model)
+    f = open(features_list_fn, "r")
+    # key files are listed relative to the directory of the list
+    list_dir = os.path.dirname(os.path.abspath(features_list_fn))
+    key_files = [os.path.join(list_dir, l.strip()) for l in f if l.strip()]
+    f.close()
+    pairs = list(read_match_table(match_table_fn))
+    pack = open_pack(key_files, os.path.join(list_dir, pack_prefix), num_workers)
+
+    settings = dict(model=model, threshold=threshold, min_inliers=min_inliers, confidence=confidence,
+                    max_iterations=max_iterations, batch_size=batch_size, seed=seed)
+    # large pairs first, in chunks of pairs of similar size
+    pairs.sort(key=lambda pair: len(pair[2]), reverse=True)
+    jobs = [(chunk, settings) for chunk in chunks(pairs, 16)]
+
+    # workers map the keypoints of the pack
+    pool = multiprocessing.Pool(num_workers, init_worker, (pack.prefix, pack.names))
+    verified = []
+    try:
+        for results in pool.imap_unordered(verify_pairs, jobs):
+            verified.extend(results)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    pool.join()
+
+    verified.sort(key=lambda v: (v[1], v[0]))
+    report = open(report_fn, "w")
+    report.write("# image_j image_i matches inliers inlier_ratio\n")
+    for j, i, num_matches, inliers in verified:
+        report.write("%d %d %d %d %.4f\n" %(j, i, num_matches, len(inliers), len(inliers)/float(max(num_matches, 1))))
+    report.close()
+
+    kept = [(j, i, inliers) for j, i, num_matches, inliers in verified
+            if len(inliers) >= min_inliers and len(inliers) >= min_inlier_ratio*num_matches]
+    replace_file(match_table_fn, "%s.unverified.txt" % os.path.splitext(match_table_fn)[0])
+    write_match_table(match_table_fn, kept)
+    return len(kept), len(verified)
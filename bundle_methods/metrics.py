@@ -0,0 +1,167 @@
+"""
+Per-stage & per-image performance metrics of a run
+
+Every stage of a run (RunBundler, AddToBundle, ReRunBundler) is measured
+with the counters of the operating system before and after it:
+	- wall time
+	- CPU time (user + system) of this process
+	- CPU time of the child processes that ended during the stage: worker
+		processes of the pools and the programs they ran (sift, KeyMatchFull,
+		bundler, RadialUndistort, pmvs2), as the kernel adds the CPU time of
+		a waited process to its parent
+	- peak RSS of this process during the stage (Linux: the peak is reset at
+		the start of every stage through /proc/self/clear_refs, elsewhere it
+		is the peak since the process started) and the peak RSS of the
+		largest child process so far
+	- bytes read & written (/proc/self/io, Linux only, waited children
+		included): by all read/write calls and by the disk
+	- counts of the outputs of the stage (photos, features, pairs, matches,
+		cameras, points, see Bundler.stage_counts)
+Images have their extraction time & features and their matches.
+
+The metrics of a run are written to the metrics directory of the SfM
+directory, as <run>.json and <run>_stages.csv, <run>_images.csv.
+"""
+import os, sys, time, json, csv
+
+try:
+	import resource
+except ImportError:
+	resource = None # win32
+
+metrics_dir = "metrics"
+
+STAGE_COLUMNS = ["stage", "wall_seconds", "cpu_seconds", "children_cpu_seconds",
+	"peak_rss_mb", "children_peak_rss_mb", "read_mb", "written_mb", "disk_read_mb", "disk_written_mb"]
+
+def io_counters():
+	"""Bytes read & written by this process and its waited children, None without /proc"""
+	try:
+		f = open("/proc/self/io", "r")
+	except IOError:
+		return None
+	counters = {}
+	for l in f:
+		name, value = l.split(":")
+		counters[name] = int(value)
+	f.close()
+	return counters
+
+def reset_peak_rss():
+	# Linux >= 4.0 resets the peak RSS of the process (VmHWM)
+	try:
+		f = open("/proc/self/clear_refs", "w")
+		f.write("5")
+		f.close()
+		return True
+	except IOError:
+		return False
+
+def peak_rss_mb(reset):
+	"""Peak RSS of this process in MB, since the last reset if reset worked"""
+	if reset:
+		f = open("/proc/self/status", "r")
+		for l in f:
+			if l.startswith("VmHWM:"):
+				f.close()
+				return int(l.split()[1]) / 1024.0
+		f.close()
+	if resource is None:
+		return None
+	return maxrss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def maxrss_mb(maxrss):
+	# ru_maxrss is in kB, in bytes on OS X
+	if sys.platform == "darwin":
+		return maxrss / (1024.0 * 1024.0)
+	return maxrss / 1024.0
+
+def cpu_times():
+	"""(CPU seconds of this process, CPU seconds of the waited children)"""
+	t = os.times()
+	return t[0] + t[1], t[2] + t[3]
+
+class Metrics(object):
+	def __init__(self, sfm_path, run_name, started=None):
+		"""sfm_path: SfM directory the metrics are written to
+			run_name: name of the run (RunBundler, AddToBundle, ...)
+			started: time the run started, default now
+		"""
+		self.sfm_path = sfm_path
+		self.run_name = run_name
+		self.started = started or time.time()
+		self.stages = []
+		self.images = []
+
+	def timed(self, name, func, counts=None):
+		"""func measured as the stage name, to be called later
+			counts: function returning a dict of output counts, called after func
+		"""
+		def run():
+			reset = reset_peak_rss()
+			io = io_counters()
+			cpu, children_cpu = cpu_times()
+			start_time = time.time()
+			func()
+			current_time = time.time()
+			stage = dict(stage=name, wall_seconds=current_time-start_time)
+			stage['cpu_seconds'], stage['children_cpu_seconds'] = [b - a for a, b in zip((cpu, children_cpu), cpu_times())]
+			stage['peak_rss_mb'] = peak_rss_mb(reset)
+			if resource is not None:
+				stage['children_peak_rss_mb'] = maxrss_mb(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+			if io is not None:
+				end_io = io_counters()
+				for column, counter in (("read_mb", "rchar"), ("written_mb", "wchar"),
+						("disk_read_mb", "read_bytes"), ("disk_written_mb", "write_bytes")):
+					stage[column] = (end_io[counter] - io[counter]) / (1024.0 * 1024.0)
+			stage['counts'] = counts() if counts is not None else {}
+			self.stages.append(stage)
+			print "\n%s took: %s seconds\nElapsed Time: %s\n" %(name, stage['wall_seconds'], current_time-self.started)
+		return run
+
+	def write(self):
+		"""Write the metrics to the SfM directory
+			OUTPUT: path of the json file
+		"""
+		out_dir = os.path.join(self.sfm_path, metrics_dir)
+		if not os.path.isdir(out_dir):
+			os.makedirs(out_dir)
+		total = time.time() - self.started
+		json_fn = os.path.join(out_dir, "%s.json" % self.run_name)
+		f = open(json_fn, "w")
+		json.dump(dict(run=self.run_name, started=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+			total_seconds=total, stages=self.stages, images=self.images), f, indent=1, sort_keys=True)
+		f.close()
+
+		count_columns = sorted(set(c for stage in self.stages for c in stage['counts']))
+		f = open(os.path.join(out_dir, "%s_stages.csv" % self.run_name), "wb")
+		writer = csv.writer(f)
+		writer.writerow(STAGE_COLUMNS + count_columns)
+		for stage in self.stages:
+			writer.writerow([stage.get(c, "") for c in STAGE_COLUMNS] + [stage['counts'].get(c, "") for c in count_columns])
+		f.close()
+
+		if self.images:
+			image_columns = sorted(set(c for image in self.images for c in image) - set(["photo"]))
+			f = open(os.path.join(out_dir, "%s_images.csv" % self.run_name), "wb")
+			writer = csv.writer(f)
+			writer.writerow(["photo"] + image_columns)
+			for image in self.images:
+				writer.writerow([image['photo']] + [image.get(c, "") for c in image_columns])
+			f.close()
+		return json_fn
+
+	def report(self):
+		"""Summary table of the stages"""
+		def mb(value):
+			return "%.1f" % value if value is not None else "-"
+		lines = ["%-20s %9s %9s %9s %9s %9s %9s  %s" %("Stage", "Wall s", "CPU s", "Child s", "RSS MB", "Read MB", "Write MB", "Counts")]
+		for stage in self.stages:
+			lines.append("%-20s %9.1f %9.1f %9.1f %9s %9s %9s  %s" %(stage['stage'], stage['wall_seconds'],
+				stage['cpu_seconds'], stage['children_cpu_seconds'], mb(stage['peak_rss_mb']),
+				mb(stage.get('read_mb')), mb(stage.get('written_mb')),
+				", ".join("%s %s" %(c, v) for c, v in sorted(stage['counts'].items()))))
+		slowest = sorted(self.images, key=lambda image: -image.get('extract_seconds', 0))[:5]
+		if slowest and 'extract_seconds' in slowest[0]:
+			lines.append("\nSlowest photos: %s" % ", ".join("%s %.2f s" %(image['photo'], image['extract_seconds']) for image in slowest))
+		return "\n".join(lines)
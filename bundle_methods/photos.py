@@ -0,0 +1,238 @@
+"""
+Photo preparation for the Bundler pipeline.
+
+The functions in this module are plain module level functions so they can
+be handed to a worker pool (processes or threads).  Every worker returns
+its own results to the caller instead of appending to shared lists, and
+only uses absolute paths: nothing in here relies on the current working
+directory.
+"""
+import os, time, hashlib
+from cStringIO import StringIO
+
+import numpy as np
+import cv2
+
+from features.container import append_features
+
+from PIL import Image
+from PIL.ExifTags import TAGS
+
+SCALE = 1.0
+EXIF_ATTRS = dict(Model=True,Make=True,ExifImageWidth=True,ExifImageHeight=True,FocalLength=True)
+
+# settings shared by all photos processed in a worker
+# set once per worker by init_worker()
+_settings = {}
+
+def init_worker(settings):
+	"""Pool initializer
+		settings: dict with src_imgs_path, sfm_path, max_size,
+		feature_engine (FeatureExtractor instance), feature_cache 
+		(FeatureCache instance or None), feature_io ('pipe' or 'file'),
+		container (prefix of the feature container), container_lock
+		(lock shared by all workers of the pool) and verbose
+	"""
+	_settings.clear()
+	_settings.update(settings)
+
+def process_photo(p):
+	"""Process a single photo (file name in src_imgs)
+		- Extract exif data (focal lengths in pixels are computed for all 
+			photos at once by focal_length_entries)
+		- see process_image
+		OUTPUT: (feature_entry, photo_info)
+	"""
+	s = _settings
+	if s['verbose']:
+		print "\nProcessing Photo '%s':" %p
+
+	photo_info = dict(dirname=s['src_imgs_path'], basename=p)
+	src_jpg_in = os.path.join(s['src_imgs_path'], p)
+
+	# read the file once: for the feature cache key and to decode it
+	src_file = open(src_jpg_in, "rb")
+	src_data = src_file.read()
+	src_file.close()
+
+	# now we open the image using PIL and get exif data
+	# (Image.open only parses the header, pixels are not decoded yet)
+	p_obj = Image.open(StringIO(src_data))
+	photo_info['exif'] = get_exif(p_obj, s['verbose'])
+
+	return process_image(p, p_obj, hashlib.sha1(src_data).hexdigest(), photo_info)
+
+def process_frame(job):
+	"""Process a single video frame
+		job: (photo name, decoded BGR frame) from video_frames
+		OUTPUT: (feature_entry, photo_info), see process_image
+	"""
+	p, frame = job
+	s = _settings
+	if s['verbose']:
+		print "\nProcessing Frame '%s':" %p
+
+	# there is no source file: extractors reading the photo from 
+	# dirname/basename use the copy in the SfM directory
+	photo_info = dict(dirname=s['sfm_path'], basename=p, exif={})
+	p_obj = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+	return process_image(p, p_obj, hashlib.sha1(frame).hexdigest(), photo_info)
+
+def process_image(p, p_obj, src_hash, photo_info):
+	"""Resize the image & extract features
+		- Save a resized copy of the photo in the SfM directory
+		- Make a grayscale .pgm (in memory, or on disk with feature_io 'file')
+		- Extract features with the feature engine 
+			(or read them from the feature cache)
+		- Append the features to the feature container, their rows
+			are returned in photo_info['rows'] (first row, rows)
+		- Wall & CPU seconds (of the worker and its child processes, so
+			of the whole pool with threads) in photo_info['extract_seconds']
+			and photo_info['extract_cpu_seconds']
+		src_hash: content hash of the source, for the feature cache
+		OUTPUT: (feature_entry, photo_info)
+	"""
+	s = _settings
+	verbose = s['verbose']
+	start_time, start_cpu = time.time(), sum(os.times()[:4])
+
+	# make file paths for output into working directory
+	jpg_out = os.path.join(s['sfm_path'], p)
+	pgm_out = "%s.pgm" % jpg_out
+
+	# resize photo if necessary
+	max_dim = max(p_obj.size)
+	if max_dim > s['max_size']:
+		scale = float(s['max_size'])/float(max_dim)
+		new_width = int(scale * p_obj.size[0])
+		new_height = int(scale * p_obj.size[1])
+		# let the JPEG decoder scale down while decoding (DCT scaling by 
+		# the largest power of two that keeps the image >= the new size)
+		p_obj.draft(p_obj.mode, (new_width, new_height))
+		p_obj = p_obj.resize((new_width, new_height))
+		if verbose:
+			print "\tCopy of the photo has been scaled down to %sx%s" %(new_width,new_height)
+
+	photo_info['width'] = p_obj.size[0]
+	photo_info['height'] = p_obj.size[1]
+
+	p_obj.save(jpg_out)
+
+	feature_engine = s['feature_engine']
+	feature_cache = s['feature_cache']
+	features = None
+	if feature_cache is not None:
+		cache_key = feature_cache.key(src_hash, s['max_size'], feature_engine)
+		features = feature_cache.fetch(cache_key)
+	photo_info['cached'] = features is not None
+
+	if not photo_info['cached']:
+		# extract feature keypoints
+		if s['feature_io'] == "pipe":
+			# grayscale pgm is encoded once in memory and handed to the extractor
+			pgm = StringIO()
+			p_obj.convert("L").save(pgm, "PPM")
+			features = feature_engine.extract(jpg_out, photo_info, pgm=pgm.getvalue())
+		else:
+			p_obj.convert("L").save(pgm_out)
+			features = feature_engine.extract(jpg_out, photo_info)
+			os.remove(pgm_out)
+		if feature_cache is not None:
+			feature_cache.store(cache_key, *features)
+	elif verbose:
+		print "\tFeatures of '%s' found in the feature cache" %p
+
+	photo_info['rows'] = append_features(s['container'], features[0], features[1], s['container_lock'])
+	photo_info['extract_seconds'] = time.time() - start_time
+	photo_info['extract_cpu_seconds'] = sum(os.times()[:4]) - start_cpu
+
+	return (p[:-4], feature_engine.fileExtension), photo_info
+
+def video_frame_count(video_path):
+	cap = cv2.VideoCapture(video_path)
+	if not cap.isOpened():
+		raise Exception, "Unable to open video '%s'" % video_path
+	num_frames = int(cap.get(7)) # cv2.CAP_PROP_FRAME_COUNT
+	cap.release()
+	return num_frames
+
+def video_frames(video_path, photos, slots, stop):
+	"""Decode the frames named in photos ("%08d.jpg" % frame number) from the video
+		The video is decoded once in order, frames in between are only grabbed.
+		This is the producer of a bounded queue: a slot is acquired for every
+		frame handed out and released by the consumer when the frame is processed.
+		Setting stop (and releasing a slot) ends the generator.
+		OUTPUT: generator of (photo name, BGR frame)
+	"""
+	wanted = sorted(set((int(os.path.splitext(p)[0]), p) for p in photos))
+	cap = cv2.VideoCapture(video_path)
+	frame_num = 0
+	try:
+		for num, p in wanted:
+			while frame_num < num and cap.grab():
+				frame_num += 1
+			ok, frame = cap.read()
+			if not ok or frame_num != num:
+				raise Exception, "Frame %s not found in '%s'" % (num, video_path)
+			frame_num += 1
+
+			slots.acquire()
+			if stop.is_set():
+				break
+			yield p, frame
+	finally:
+		cap.release()
+
+def bounded_jobs(jobs, slots, stop):
+	"""Hand out jobs like video_frames: a slot is acquired for every job
+		and released by the consumer, setting stop ends the generator
+		OUTPUT: generator of the jobs
+	"""
+	for job in jobs:
+		slots.acquire()
+		if stop.is_set():
+			break
+		yield job
+
+def get_exif(p_obj, verbose=False):
+	# helper function to extract exif data from .jpgs
+	exif = {}
+	info = p_obj._getexif()
+	if info:
+		for attr, value in info.items():
+			decoded_attr = TAGS.get(attr, attr)
+			if decoded_attr in EXIF_ATTRS:
+				exif[decoded_attr] = value
+	if 'FocalLength' in exif:
+		exif['FocalLength'] = float(exif['FocalLength'][0])/float(exif['FocalLength'][1])
+		if verbose: print "exif['FocalLength']: \t", exif['FocalLength']
+
+	return exif
+
+def focal_length_entries(photo_infos, sensor_index, verbose=False):
+	"""Bundler list entries for all photos, with focal length in pixels
+		looked up in one pass over the photos with the camera sensor index
+		OUTPUT: list of entries eg: [("000001.jpg", 0, 524.2), ...]
+			photos with a focal length but an unknown camera are left out
+	"""
+	exifs = [i['exif'] for i in photo_infos]
+	focal_pixels = sensor_index.focal_pixels(
+		[e.get('Make', '') for e in exifs], [e.get('Model', '') for e in exifs],
+		[e.get('FocalLength', 0) for e in exifs], 
+		[e.get('ExifImageWidth', 0) for e in exifs], [e.get('ExifImageHeight', 0) for e in exifs])
+
+	photo_list = []
+	for photo_info, exif, f in zip(photo_infos, exifs, focal_pixels):
+		if 'FocalLength' not in exif:
+			if verbose:
+				print "\tCan't estimate focal length in pixels for the photo '%s'" % os.path.join(photo_info['dirname'],photo_info['basename'])
+			photo_list.append((photo_info['basename'],0,' '))
+		elif not np.isnan(f):
+			photo_list.append((photo_info['basename'],0,SCALE*f))
+			if verbose:
+				print "\nAdded image %s to the photo_list with focal length: %s" \
+						%(photo_info['basename'], SCALE*f)
+		elif verbose and sensor_index.ccd_width(exif.get('Make', ''), exif.get('Model', '')) is None:
+			print "\tEntry for the camera '%s', '%s' does not exist in the camera database" % (exif.get('Make'), exif.get('Model'))
+	return photo_list
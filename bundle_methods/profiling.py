@@ -0,0 +1,181 @@
+"""
+Opt-in profiling of the stages of RunBundler, RunPMVS & RunBrowser
+
+Enabled with -pf <directory> (or the environment variable PUPIL3D_PROFILE),
+every stage run through Profiler.stage and every call of a callback
+wrapped by Profiler.calls (Visualize.on_draw) is profiled with:
+	- cProfile: <n>_<stage>.prof (load with pstats or snakeviz) and the
+		30 most expensive functions by cumulative time in <n>_<stage>.txt
+	- a sampling thread taking the stack of the main thread every 5 ms:
+		<n>_<stage>.collapsed, one "frame;frame;frame count" line per
+		stack, the input of flamegraph.pl or speedscope
+	- the top allocation sites: with tracemalloc (Python >= 3.4) the source
+		lines that allocated the memory still held at the end of the stage,
+		on Python 2 the object types whose number of live objects grew
+		the most (gc census), in <n>_<stage>.alloc.txt
+The files of a run are written to <directory>/<run>/ when the stage ends,
+the files of a callback every 600 calls and when the process exits.
+
+Only the main process is profiled: the work of pool processes shows as
+the time the main process waits for them (see metrics.py for their CPU time).
+"""
+import os, sys, time, gc, atexit, threading, functools
+import cProfile, pstats
+from collections import Counter
+from cStringIO import StringIO
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None # Python 2
+
+PROFILE_ENV = "PUPIL3D_PROFILE"
+SAMPLE_INTERVAL = 0.005
+TOP_FUNCTIONS = 30
+TOP_ALLOCATIONS = 25
+CALLS_PER_DUMP = 600
+
+def profile_dir(option=None):
+	"""Profile directory of a command line option, or of PUPIL3D_PROFILE"""
+	return option or os.environ.get(PROFILE_ENV) or None
+
+def frame_name(frame):
+	code = frame.f_code
+	return "%s (%s:%d)" %(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+def collapse(frame):
+	# outermost frame first, like flamegraph.pl expects
+	names = []
+	while frame is not None:
+		names.append(frame_name(frame))
+		frame = frame.f_back
+	return ";".join(reversed(names))
+
+class Allocations(object):
+	"""Allocation sites of a stage, tracemalloc if available, or a census of live objects"""
+	def __init__(self):
+		if tracemalloc is not None:
+			if not tracemalloc.is_tracing():
+				tracemalloc.start()
+			self.before = tracemalloc.take_snapshot()
+		else:
+			self.before = self.census()
+
+	def census(self):
+		gc.collect()
+		return Counter(type(o).__name__ for o in gc.get_objects())
+
+	def report(self):
+		if tracemalloc is not None:
+			stats = tracemalloc.take_snapshot().compare_to(self.before, "lineno")[:TOP_ALLOCATIONS]
+			return "# size_diff_kb count_diff site\n" + "".join("%.1f %d %s\n" %(s.size_diff/1024.0, s.count_diff, s.traceback) for s in stats)
+		growth = self.census()
+		growth.subtract(self.before)
+		return "# live objects grew by (Python 2: no tracemalloc, gc census of object types)\n" + \
+			"".join("%d %s\n" %(count, name) for name, count in growth.most_common(TOP_ALLOCATIONS) if count > 0)
+
+class Profile(object):
+	"""Profile of one stage or callback"""
+	def __init__(self, name, prefix):
+		self.name = name
+		self.prefix = prefix
+		self.profile = cProfile.Profile()
+		self.stacks = Counter()
+		self.allocations = None
+		self.calls = 0
+
+	def write(self):
+		self.profile.dump_stats("%s.prof" % self.prefix)
+		summary = StringIO()
+		pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+		f = open("%s.txt" % self.prefix, "w")
+		f.write(summary.getvalue())
+		f.close()
+		f = open("%s.collapsed" % self.prefix, "w")
+		for stack, count in sorted(self.stacks.items()):
+			f.write("%s %d\n" %(stack, count))
+		f.close()
+		f = open("%s.alloc.txt" % self.prefix, "w")
+		f.write(self.allocations.report())
+		f.close()
+
+class Profiler(object):
+	def __init__(self, out_dir, run_name):
+		"""out_dir: profile directory, None to disable profiling
+			run_name: the files are written to out_dir/run_name
+		"""
+		self.enabled = out_dir is not None
+		self.active = None
+		self.count = 0
+		if not self.enabled:
+			return
+		self.out_dir = os.path.join(os.path.abspath(os.path.expanduser(out_dir)), run_name)
+		if not os.path.isdir(self.out_dir):
+			os.makedirs(self.out_dir)
+		self.main_thread = threading.current_thread().ident
+		sampler = threading.Thread(target=self.sample)
+		sampler.daemon = True
+		sampler.start()
+
+	def sample(self):
+		# stacks of the main thread while a profile is active
+		while True:
+			time.sleep(SAMPLE_INTERVAL)
+			active = self.active
+			if active is not None:
+				frame = sys._current_frames().get(self.main_thread)
+				if frame is not None:
+					active.stacks[collapse(frame)] += 1
+
+	def new_profile(self, name):
+		self.count += 1
+		return Profile(name, os.path.join(self.out_dir, "%02d_%s" %(self.count, name)))
+
+	def enter(self, profile):
+		self.active = profile
+		profile.profile.enable()
+
+	def leave(self, profile):
+		profile.profile.disable()
+		self.active = None
+
+	def stage(self, name, func):
+		"""func profiled as the stage name, to be called later (func itself if profiling is disabled)"""
+		if not self.enabled:
+			return func
+		def run():
+			profile = self.new_profile(name)
+			profile.allocations = Allocations()
+			self.enter(profile)
+			try:
+				return func()
+			finally:
+				self.leave(profile)
+				profile.write()
+				print "\nProfile of %s: %s.*\n" %(name, profile.prefix)
+		return run
+
+	def calls(self, name, func):
+		"""func profiled across all its calls as name (func itself if profiling is disabled)
+			The wrapper keeps the name of func, event handlers are registered by name.
+		"""
+		if not self.enabled:
+			return func
+		profile = self.new_profile(name)
+		def write_at_exit():
+			if profile.calls:
+				profile.write()
+		atexit.register(write_at_exit)
+		@functools.wraps(func)
+		def call(*args, **kwargs):
+			if profile.allocations is None:
+				profile.allocations = Allocations()
+			self.enter(profile)
+			try:
+				return func(*args, **kwargs)
+			finally:
+				self.leave(profile)
+				profile.calls += 1
+				if profile.calls % CALLS_PER_DUMP == 0:
+					profile.write()
+		return call
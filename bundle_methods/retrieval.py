@@ -0,0 +1,177 @@
+"""
+Image retrieval with a vocabulary tree, to choose the image pairs to match
+
+A hierarchical k-means tree (branching^depth visual words) is trained on
+a sample of the descriptors of all images.  Every image becomes a TF-IDF
+weighted histogram of its visual words and is paired with the top_k
+images with the most similar histograms (cosine similarity).  The edges
+of the maximum spanning tree of the similarities are added, so the pairs
+always connect all images into one component.
+
+Descriptors are read from the feature container (see matching/pack.py)
+in a pool of worker processes, twice: once for the training sample and
+once to quantize all descriptors.  Only the sample and the word
+histograms are sent back, never all descriptors.
+"""
+import os
+import multiprocessing
+
+import numpy as np
+import cv2
+
+from features.container import CONTAINER_PREFIX
+from matching.pack import open_pack, FeaturePack
+
+# FeaturePack of the images & vocabulary tree used by the workers, set by init_worker()
+_pack = None
+_tree = None
+
+def init_worker(pack_prefix, names, tree=None):
+	global _pack, _tree
+	_pack = FeaturePack(pack_prefix, names)
+	_tree = tree
+
+def sample_descriptors(job):
+	n, num_samples, seed = job
+	descriptors = _pack.image_descriptors(n)
+	if len(descriptors) > num_samples:
+		rs = np.random.RandomState(seed)
+		descriptors = descriptors[rs.choice(len(descriptors), num_samples, replace=False)]
+	return descriptors
+
+def word_histogram(n):
+	descriptors = _pack.image_descriptors(n)
+	return np.bincount(_tree.quantize(descriptors), minlength=_tree.num_words)
+
+class VocabularyTree(object):
+	"""Hierarchical k-means tree over descriptors
+		levels[l]: centers of the nodes at depth l+1, the children of node n
+			are levels[l][n*branching:(n+1)*branching]
+	"""
+	def __init__(self, branching=10, depth=4):
+		self.branching = branching
+		self.depth = depth
+		self.num_words = branching**depth
+		self.levels = []
+
+	def train(self, descriptors, iterations=10):
+		data = descriptors.astype(np.float32)
+		b = self.branching
+		criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, iterations, 1.0)
+		labels = np.zeros(len(data), dtype=np.int64)
+		parent_centers = data.mean(axis=0)[None]
+		self.levels = []
+		for level in xrange(self.depth):
+			centers = np.empty((len(parent_centers)*b, data.shape[1]), dtype=np.float32)
+			new_labels = np.empty_like(labels)
+			order = np.argsort(labels, kind='mergesort')
+			bounds = np.searchsorted(labels[order], np.arange(len(parent_centers)+1))
+			for node in xrange(len(parent_centers)):
+				members = order[bounds[node]:bounds[node+1]]
+				if len(members) > b:
+					compactness, node_labels, node_centers = cv2.kmeans(data[members], b, None,
+						criteria, 1, cv2.KMEANS_PP_CENTERS)
+					node_labels = node_labels.ravel()
+				else:
+					# too few descriptors: one child per descriptor,
+					# the others repeat the node center and stay empty
+					node_centers = np.repeat(parent_centers[node][None], b, axis=0)
+					node_centers[:len(members)] = data[members]
+					node_labels = np.arange(len(members))
+				centers[node*b:(node+1)*b] = node_centers
+				new_labels[members] = node*b + node_labels
+			self.levels.append(centers)
+			labels, parent_centers = new_labels, centers
+		return self
+
+	def quantize(self, descriptors, chunk_size=2048):
+		"""OUTPUT: visual word (leaf number) of every descriptor"""
+		data = descriptors.astype(np.float32)
+		words = np.zeros(len(data), dtype=np.int64)
+		for start in xrange(0, len(data), chunk_size):
+			x = data[start:start+chunk_size]
+			node = np.zeros(len(x), dtype=np.int64)
+			for centers in self.levels:
+				children = centers.reshape(-1, self.branching, centers.shape[1])[node]
+				dist = ((children - x[:,None,:])**2).sum(axis=-1)
+				node = node*self.branching + dist.argmin(axis=1)
+			words[start:start+chunk_size] = node
+		return words
+
+def tfidf_similarity(histograms):
+	"""Cosine similarity of the TF-IDF weighted word histograms of all images"""
+	histograms = np.asarray(histograms, dtype=np.float32)
+	num_images = len(histograms)
+	df = (histograms > 0).sum(axis=0)
+	idf = np.log(float(num_images) / np.maximum(df, 1)).astype(np.float32)
+	tf = histograms / np.maximum(histograms.sum(axis=1), 1)[:,None]
+	vectors = tf * idf
+	vectors /= np.maximum(np.sqrt((vectors**2).sum(axis=1)), 1e-12)[:,None]
+	return np.dot(vectors, vectors.T)
+
+def spanning_tree_pairs(similarity):
+	"""Edges of the maximum spanning tree (Prim) of the similarity matrix"""
+	n = len(similarity)
+	pairs = set()
+	if n < 2:
+		return pairs
+	in_tree = np.zeros(n, dtype=bool)
+	in_tree[0] = True
+	best = similarity[0].astype(np.float64)
+	parent = np.zeros(n, dtype=np.int64)
+	for step in xrange(n-1):
+		k = int(np.argmax(np.where(in_tree, -np.inf, best)))
+		pairs.add((min(k, parent[k]), max(k, parent[k])))
+		in_tree[k] = True
+		closer = similarity[k] > best
+		best[closer] = similarity[k][closer]
+		parent[closer] = k
+	return pairs
+
+def top_k_pairs(similarity, top_k):
+	"""Every image with its top_k most similar images, plus the spanning tree
+		OUTPUT: sorted list of (j, i) with j < i
+	"""
+	n = len(similarity)
+	similarity = similarity.copy()
+	np.fill_diagonal(similarity, -np.inf)
+	pairs = spanning_tree_pairs(similarity)
+	k = min(top_k, n-1)
+	if k > 0:
+		nearest = np.argpartition(-similarity, k-1, axis=1)[:,:k]
+		for i in xrange(n):
+			for j in nearest[i]:
+				pairs.add((min(i, j), max(i, j)))
+	return sorted((int(j), int(i)) for j, i in pairs)
+
+def retrieve_pairs(key_files, top_k, num_workers=8, branching=10, depth=4, max_train=200000, seed=0):
+	"""Candidate pairs (j, i) of indices into key_files, see top_k_pairs"""
+	pack = open_pack(key_files, os.path.join(os.path.dirname(key_files[0]), CONTAINER_PREFIX), num_workers)
+	per_image = max(max_train // max(len(key_files), 1), 1)
+	pool = multiprocessing.Pool(num_workers, init_worker, (pack.prefix, pack.names))
+	try:
+		sample = pool.map(sample_descriptors, [(n, per_image, seed+n) for n in xrange(len(key_files))])
+	finally:
+		pool.close()
+		pool.join()
+	tree = VocabularyTree(branching, depth).train(np.concatenate(sample))
+
+	pool = multiprocessing.Pool(num_workers, init_worker, (pack.prefix, pack.names, tree))
+	try:
+		histograms = pool.map(word_histogram, xrange(len(key_files)))
+	finally:
+		pool.close()
+		pool.join()
+	return top_k_pairs(tfidf_similarity(histograms), top_k)
+
+def write_pairs(fn, pairs):
+	f = open(fn, "w")
+	for j, i in pairs:
+		f.write("%d %d\n" %(j, i))
+	f.close()
+
+def read_pairs(fn):
+	f = open(fn, "r")
+	pairs = [tuple(int(v) for v in l.split()) for l in f if l.strip()]
+	f.close()
+	return pairs
@@ -0,0 +1,95 @@
+"""
+Resumable pipeline stages with up-to-date checks
+
+The stages of RunBundler & RunPMVS (extract -> match -> bundle -> undistort
+-> bundle2pmvs -> pmvs) run in order, every completed stage is recorded in
+stages.json in the SfM directory with:
+	- its parameters (options that change its outputs)
+	- fingerprints of its input files and directories
+	- fingerprints of its output files and directories
+A fingerprint is the SHA-1 of the size and modification time of a file,
+or of all files below a directory, so checking a stage costs a few stat
+calls, never reading the data.
+
+A stage is skipped when its record matches the current parameters, inputs
+and outputs.  The first stage that is not up to date and all the stages
+after it run again, so a crashed or interrupted run resumes from the
+stage that did not complete: its record is removed before it starts and
+written when it returns.
+"""
+import os, json, hashlib, time
+
+from storage import write_file
+
+def fingerprint(path):
+	"""SHA-1 of the size & modification time of path (all files below a directory)
+		"missing" for paths that do not exist
+	"""
+	if not os.path.exists(path):
+		return "missing"
+	sha1 = hashlib.sha1()
+	if os.path.isdir(path):
+		for dirpath, dirnames, filenames in os.walk(path):
+			dirnames.sort()
+			for fn in sorted(filenames):
+				p = os.path.join(dirpath, fn)
+				st = os.stat(p)
+				sha1.update("%s %d %r\n" %(os.path.relpath(p, path), st.st_size, st.st_mtime))
+	else:
+		st = os.stat(path)
+		sha1.update("%d %r\n" %(st.st_size, st.st_mtime))
+	return sha1.hexdigest()
+
+class StageLog(object):
+	def __init__(self, log_fn, rerun=False):
+		"""log_fn: stages.json, paths of the stages are relative to its directory
+			rerun: run all stages, even the stages that are up to date
+		"""
+		self.log_fn = os.path.abspath(log_fn)
+		self.base_dir = os.path.dirname(self.log_fn)
+		self.stale = rerun
+		self.records = {}
+		if os.path.exists(self.log_fn):
+			f = open(self.log_fn, "r")
+			try:
+				self.records = json.load(f)
+			except ValueError:
+				self.records = {} # written by a crashed run
+			f.close()
+
+	def fingerprints(self, paths):
+		return dict((p, fingerprint(os.path.join(self.base_dir, p))) for p in paths)
+
+	def save(self):
+		write_file(self.log_fn, json.dumps(self.records, indent=1, sort_keys=True))
+
+	def up_to_date(self, name, inputs, outputs, params):
+		record = self.records.get(name)
+		if record is None:
+			return False
+		# compare with the parameters as they read back from json
+		return (record['params'] == json.loads(json.dumps(params)) and
+				record['inputs'] == self.fingerprints(inputs) and
+				record['outputs'] == self.fingerprints(outputs))
+
+	def run(self, name, func, inputs=(), outputs=(), params=None):
+		"""Run func() unless the stage name is up to date
+			inputs, outputs: files & directories read and written by the stage
+			params: json serializable options of the stage
+			OUTPUT: True if func ran
+		"""
+		params = params or {}
+		if not self.stale and self.up_to_date(name, inputs, outputs, params):
+			print "\nStage '%s' is up to date, skipped (see %s)" %(name, os.path.basename(self.log_fn))
+			return False
+		# every following stage runs again
+		self.stale = True
+		self.records.pop(name, None)
+		self.save()
+		record = dict(params=params, inputs=self.fingerprints(inputs))
+		func()
+		record['outputs'] = self.fingerprints(outputs)
+		record['finished'] = time.strftime("%Y-%m-%d %H:%M:%S")
+		self.records[name] = record
+		self.save()
+		return True
@@ -0,0 +1,46 @@
+"""
+Helpers shared by the files that persist across runs
+
+The feature cache, the match store, the feature container index and the
+stage log (stages.json) are read by other processes or later runs while
+they are written.  write_file replaces a file through a temporary file in
+the same directory and a rename (replace_file), so readers never see a
+partial file.
+Entries of the caches & stores are keyed on the class name and the
+parameters of the extractor or matcher that made them (cache_key).
+"""
+import os, sys, tempfile
+
+def write_file(path, data):
+	"""Write data (a string) to path, replacing the file atomically
+		through a temporary file in the same directory (see replace_file).
+		If another process wrote path meanwhile (the rename fails but path
+		exists) its file is kept.
+	"""
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+	f = os.fdopen(fd, "wb")
+	f.write(data)
+	f.close()
+	try:
+		replace_file(tmp, path)
+	except OSError:
+		os.remove(tmp)
+		if not os.path.exists(path):
+			raise
+
+def replace_file(src, dst):
+	"""Rename src to dst, replacing dst if it exists
+		os.rename does not replace existing files on win32: dst is removed
+		first there.
+	"""
+	if sys.platform == "win32" and os.path.exists(dst):
+		try:
+			os.remove(dst)
+		except OSError:
+			pass # removed by another writer
+	os.rename(src, dst)
+
+def cache_key(obj):
+	"""Class name & parameters (names in obj.params) of a feature extractor or matcher"""
+	return "%s(%s)" % (obj.__class__.__name__,
+		", ".join(["%s=%r" % (p, getattr(obj, p)) for p in obj.params]))
@@ -1,6 +1,9 @@
 import logging
 import sys, os, argparse, tempfile, subprocess, shutil
 
+from bundle_methods.stages import StageLog
+from bundle_methods import profiling
+
 	
 distrPath = os.path.dirname( os.path.abspath(sys.argv[0]) )
 
@@ -14,6 +17,13 @@ RadialUndistordExecutable = os.path.join(bundlerBinPath, "RadialUndistort")
 Bundle2VisExecutable = os.path.join(bundlerBinPath, "Bundle2Vis")
 
 bundlerListFileName = "list.txt"
+stagesFileName = "stages.json"
+
+# (inputs, outputs) of the stages of RunPMVS, relative to the bundler output path
+pmvsStages = {
+	"bundle2pmvs": ([bundlerListFileName, "bundle/bundle.out"], ["pmvs/txt", "pmvs/visualize", "pmvs/vis.dat"]),
+	"pmvs": (["pmvs/txt", "pmvs/visualize", "pmvs/vis.dat"], ["pmvs/models"]),
+}
 
 #commandLineLongFlags = ["bundlerOutputPath="]
 
@@ -40,6 +50,11 @@ class Pmvs():
 		if not os.path.isdir(self.data_in):
 			raise Exception, "'%s' is not a directory.  Please specify a directory where bundler output files are located." % self.data_in
 
+		# shares the stage log of RunBundler, completed stages are skipped
+		self.stages = StageLog(os.path.join(self.workDir, stagesFileName), self.force_stages)
+		# stages are profiled with -pf or PUPIL3D_PROFILE
+		self.profiler = profiling.Profiler(profiling.profile_dir(self.profile), "RunPMVS")
+
 	def parseCommandLineFlags(self):
 		parser = argparse.ArgumentParser(description="Run PMVS2 from a sparse bundler reconstruction.")
 		parser.add_argument('-d', '--data_in', type=str,
@@ -47,6 +62,15 @@ class Pmvs():
 			required=True)
 		parser.add_argument('-dout', '--data_out', type=str,
 			help='Specify the location for the PMVS2 output (default = /pmvs).')
+		parser.add_argument('-fs', '--force_stages', type=bool,
+			help="Set to True to run all stages again. By default the stages completed by an earlier run are skipped while their inputs and outputs are unchanged (see %s)." % stagesFileName,
+			default=False)
+		parser.add_argument('-nw', '--no_window', type=bool,
+			help="Set to True to not open the result in a file browser at the end (batch runs, see RunBatch.py).",
+			default=False)
+		parser.add_argument('-pf', '--profile', type=str,
+			help="Profile every stage (cProfile, sampled stacks for flamegraphs, allocation sites) into this directory, see bundle_methods/profiling.py. Default = $%s, no profiling if unset." % profiling.PROFILE_ENV,
+			default=None)
 
  		try:
 			args = parser.parse_args(namespace=self)						
@@ -72,16 +96,16 @@ class Pmvs():
 		# just run Bundle2PMVS here
 		logging.info("\nPerforming Bundler2PMVS conversion...")
 		os.chdir(self.workDir)
-		os.mkdir("pmvs")
 
-		# Create directory structure
-		os.mkdir("pmvs/txt")
-		os.mkdir("pmvs/visualize")
-		os.mkdir("pmvs/models")
+		# Create directory structure (kept from an interrupted run)
+		for d in ("pmvs", "pmvs/txt", "pmvs/visualize", "pmvs/models"):
+			if not os.path.isdir(d):
+				os.mkdir(d)
 		
 		#$BASE_PATH/bin32/Bundle2PMVS.exe list.txt	bundle/bundle.out
 		print "Running Bundle2PMVS to generate geometry and converted camera file"
-		subprocess.call([bundler2PmvsExecutable, "list.txt", "./bundle/bundle.out"])
+		if subprocess.call([bundler2PmvsExecutable, "list.txt", "./bundle/bundle.out"]) != 0:
+			raise Exception, "Bundle2PMVS failed"
 		
 		# Apply radial undistortion to the images
 		print "Running RadialUndistort to undistort input images"
@@ -111,13 +135,25 @@ class Pmvs():
 		
 	def doPMVS(self):
 		print "Run PMVS2 : %s " % pmvsExecutable
-		subprocess.call([pmvsExecutable, "./", "pmvs_options.txt"])
+		os.chdir(os.path.join(self.workDir,"pmvs"))
+		returncode = subprocess.call([pmvsExecutable, "./", "pmvs_options.txt"])
+		# a failed stage is not recorded as completed
+		if returncode != 0:
+			raise Exception, "PMVS2 failed with exit code %s" % returncode
+
+	def runStage(self, name, func):
+		# run func as the stage name, unless it is up to date
+		inputs, outputs = pmvsStages[name]
+		return self.stages.run(name, func, inputs, outputs)
 	
 	# def printHelpExit(self):
 	# 	self.printHelp()
 	# 	sys.exit(2)
 	
 	def openResult(self):
+		if self.no_window:
+			print "See the results in the '%s' directory" % self.workDir
+			return
 		if sys.platform == "win32": subprocess.call(["explorer", self.workDir])
 		else: 
 			print "See the results in the '%s' directory" % self.workDir